@@ -0,0 +1,104 @@
+# Cold start and warm invocation latency of the lambdas for each source TYPE, without AWS.
+#
+# Each TYPE runs in a fresh process, like a new lambda container. The benchmark times the import of
+# the lambda module, the import of boto3 and the creation of the real boto3 clients the first
+# invocation needs (no network is used to create a client), then the first and a warm invocation
+# against the fakes of fakes.py. The "eager" column is what the same cold start costs when every
+# client and BeautifulSoup are set up at import time whatever the invocation does.
+#
+# Usage: python benchmarks/bench_cold_start.py [--files N] [--types HARVESTER,LINKS,DIRECT,...]
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fakes
+from bench_pipeline import source_rows
+
+TYPES = ['HARVESTER', 'LINKS', 'LINKS_OVERWRITE', 'DIRECT', 'FTP_FILES', 'DIRECT_FTP']
+HEAVY = ('boto3', 'botocore', 'urllib3', 'bs4')
+SERVICES = {'data_harvester': ('sqs', 's3'), 'data_downloader': ('sqs', 's3', 'sns')}
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def client_ms(services):
+    '''Time to create a real boto3 client of each service, the first one also creates the session'''
+    import boto3
+    session = boto3.session.Session()
+    return {service: timed(session.client, service)[1] for service in services}
+
+
+def child(source_type, files):
+    fakes.environment({'consumer_mode': 'drain', 'safety_margin': '1'})
+    name = 'data_harvester' if source_type == 'HARVESTER' else 'data_downloader'
+    module, import_ms = timed(__import__, name)
+    loaded = [heavy for heavy in HEAVY if heavy in sys.modules]
+    _, boto3_ms = timed(__import__, 'boto3')
+
+    clients = fakes.install()
+    source = 'LINKS' if source_type == 'HARVESTER' else source_type
+    http_url = fakes.start_http(files, 1024)
+    ftp_url = fakes.start_ftp(tempfile.mkdtemp(), ['s0'], files, 1024) if 'FTP' in source else ''
+    clients['s3'].store('sources.csv', source_rows(source, 1, http_url, ftp_url))
+
+    if source_type == 'HARVESTER':
+        invoke = lambda: module.handler({}, fakes.FakeContext())
+    else:
+        import data_harvester
+
+        def invoke():
+            data_harvester.handler({}, fakes.FakeContext())
+            module.handler({}, fakes.FakeContext())
+    _, first_ms = timed(invoke)
+    _, warm_ms = timed(invoke)
+
+    # The clients the first invocations created, timed again for real
+    used = [service for service in SERVICES[name] if getattr(module, service).client is not None]
+    created = client_ms(used)
+    unused = client_ms([service for service in SERVICES[name] if service not in used])
+    # The harvester never parsed pages
+    _, bs4_ms = timed(__import__, 'bs4') if name == 'data_downloader' and 'bs4' not in sys.modules else (None, 0.0)
+    lazy = import_ms + boto3_ms + sum(created.values()) + first_ms
+    print(json.dumps({'import_ms': import_ms, 'loaded_at_import': loaded, 'boto3_ms': boto3_ms,
+                      'clients_ms': created, 'first_ms': first_ms, 'warm_ms': warm_ms,
+                      'cold_ms': lazy, 'eager_ms': lazy + sum(unused.values()) + bs4_ms}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=5)
+    parser.add_argument('--types', default=','.join(TYPES))
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args.child, args.files)
+
+    print(f'{"TYPE":<16} {"import ms":>9} {"boto3 ms":>9} {"clients":<18} {"first ms":>9} {"warm ms":>8} '
+          f'{"cold ms":>8} {"eager ms":>9}  loaded at import')
+    for source_type in args.types.split(','):
+        if 'FTP' in source_type:
+            try:
+                import pyftpdlib
+            except ImportError:
+                print(f'{source_type:<16} skipped, pyftpdlib is not installed')
+                continue
+        command = [sys.executable, __file__, '--child', source_type, '--files', str(args.files)]
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        r = json.loads(output.strip().splitlines()[-1])
+        clients = ','.join(f'{service}:{ms:.0f}' for service, ms in r['clients_ms'].items())
+        print(f'{source_type:<16} {r["import_ms"]:>9.1f} {r["boto3_ms"]:>9.1f} {clients:<18} {r["first_ms"]:>9.1f} '
+              f'{r["warm_ms"]:>8.1f} {r["cold_ms"]:>8.1f} {r["eager_ms"]:>9.1f}  {",".join(r["loaded_at_import"]) or "-"}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# Many small files from one host: urllib.request.urlopen per file vs the pooled http_session.
+#
+# The local server speaks HTTP/1.1 keep-alive and counts the TCP connections it accepts,
+# so the output shows both the time and the number of handshakes each client needed.
+#
+# Usage: python benchmarks/bench_http_pool.py [file_count] [file_size_kb]
+
+import http.server
+import os
+import sys
+import threading
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data-downloader'))
+import http_session
+
+
+class KeepAliveHandler(http.server.BaseHTTPRequestHandler):
+    '''Serve /<n> as file_size_kb KB of data over keep-alive connections'''
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    body = b''
+    connections = 0
+
+    def setup(self):
+        super().setup()
+        KeepAliveHandler.connections += 1
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+def run(name, fetch, urls):
+    KeepAliveHandler.connections = 0
+    start = time.perf_counter()
+    for url in urls:
+        fetch(url)
+    elapsed = time.perf_counter() - start
+    print(f'{name:>10} {elapsed:>8.3f}s {len(urls) / elapsed:>10.0f} files/s {KeepAliveHandler.connections:>6} connections')
+
+
+def fetch_urllib(url):
+    with urllib.request.urlopen(url) as response:
+        response.read()
+
+
+def fetch_pooled(url):
+    with http_session.open_url(url) as response:
+        response.read()
+
+
+def main(count, size_kb):
+    KeepAliveHandler.body = b'x' * (size_kb * 1024)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    urls = [f'http://127.0.0.1:{server.server_port}/{n}' for n in range(count)]
+    print(f'{count} files of {size_kb}KB')
+    run('urllib', fetch_urllib, urls)
+    run('pooled', fetch_pooled, urls)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:]]
+    main(*(args + [1000, 4][len(args):]))
@@ -0,0 +1,59 @@
+# Link extraction from large synthetic NEMweb style index pages:
+# BeautifulSoup (the fallback) vs the streaming scanner of link_extractor.
+#
+# Reports the time and the peak memory allocated (tracemalloc) to get the links of each page,
+# the in-memory page itself is not counted.
+#
+# Usage: python benchmarks/bench_link_extraction.py [link_count ...]
+
+import io
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data-downloader'))
+import link_extractor
+
+BASE_URL = 'http://nemweb.com.au/Reports/Current/Dispatch_SCADA/'
+
+
+def index_page(count):
+    rows = ''.join(f'Monday, 1 January 2024 12:{n % 60:02d} AM {20000 + n:>10} '
+                   f'<A HREF="/Reports/Current/Dispatch_SCADA/PUBLIC_DISPATCHSCADA_{202401010000 + n}_{n:016d}.zip">'
+                   f'PUBLIC_DISPATCHSCADA_{202401010000 + n}_{n:016d}.zip</A><br>'
+                   for n in range(count))
+    return f'<html><head><title>nemweb.com.au - /Reports/Current/Dispatch_SCADA/</title></head><body><H1>Dispatch_SCADA</H1><hr><pre>{rows}</pre><hr></body></html>'.encode()
+
+
+def soup(page):
+    return list(link_extractor.filter_links(link_extractor.soup_hrefs(page), BASE_URL, '*.zip'))
+
+
+def stream(page):
+    return list(link_extractor.filter_links(link_extractor.iter_hrefs(io.BytesIO(page)), BASE_URL, '*.zip'))
+
+
+def measure(extract, page):
+    start = time.perf_counter()
+    links = extract(page)
+    elapsed = time.perf_counter() - start
+    # Traced separately, tracemalloc slows the extraction down
+    tracemalloc.start()
+    extract(page)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return len(links), elapsed, peak / 1024 / 1024
+
+
+def main(counts):
+    print(f'{"links":>8} {"page MB":>8} {"parser":>8} {"found":>8} {"seconds":>8} {"peak MB":>8}')
+    for count in counts:
+        page = index_page(count)
+        for name, extract in (('bs4', soup), ('stream', stream)):
+            found, elapsed, peak = measure(extract, page)
+            print(f'{count:>8} {len(page) / 1024 / 1024:>8.1f} {name:>8} {found:>8} {elapsed:>8.3f} {peak:>8.1f}')
+
+
+if __name__ == '__main__':
+    main([int(c) for c in sys.argv[1:]] or [1000, 10000, 50000])
@@ -0,0 +1,115 @@
+# End-to-end throughput of harvester -> SQS -> downloader for each source TYPE, without AWS.
+#
+# S3/SQS/SNS are the in-memory fakes of fakes.py, the market operator sites are a local HTTP server
+# and a local FTP server (pyftpdlib, FTP types are skipped without it) serving synthetic listings
+# and files. Each TYPE runs in its own process: the harvester enqueues every source, then the
+# downloader (consumer_mode=drain) is invoked until the queue is empty. A second "repeat" pass over
+# the same sources shows the cost of files that are already ingested. With --dispatch fanout the
+# listing types enqueue one FILE task per file, which the following invocations transfer.
+#
+# Usage: python benchmarks/bench_pipeline.py [--sources N] [--files N] [--size KB] [--types LINKS,DIRECT,...]
+#                                            [--dispatch inline|fanout]
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fakes
+
+TYPES = ['LINKS', 'LINKS_OVERWRITE', 'DIRECT', 'FTP_FILES', 'DIRECT_FTP']
+
+
+def source_rows(source_type, count, http_url, ftp_url):
+    rows = ['ID,URL,Interval,Description,Active,Owner,Notes,TYPE,PATTERN,UTC']
+    for n in range(count):
+        name = f's{n}'
+        url, pattern = {
+            'LINKS': (f'{http_url}{name}/', '*.csv'),
+            'LINKS_OVERWRITE': (f'{http_url}{name}/', '*.csv'),
+            'DIRECT': (f'{http_url}{name}/{name}_0.csv', f'{name}.csv'),
+            'FTP_FILES': (f'{ftp_url}{name}/', '*.csv'),
+            'DIRECT_FTP': (f'{ftp_url}{name}/{name}_0.csv', f'{name}.csv'),
+        }[source_type]
+        rows.append(f'{name},{url},bench,,1,,,{source_type},{pattern},0')
+    return '\r\n'.join(rows).encode()
+
+
+def run_pass(clients, data_harvester, data_downloader):
+    s3, sqs = clients['s3'], clients['sqs']
+    files, size = s3.uploaded_files, s3.uploaded_bytes
+    calls = {name: sum(client.calls.values()) for name, client in clients.items()}
+    start = time.perf_counter()
+    data_harvester.handler({}, fakes.FakeContext())
+    sources = len(sqs.queue)
+    while sqs.queue:
+        data_downloader.handler({}, fakes.FakeContext())
+    elapsed = time.perf_counter() - start
+    return {'sources': sources, 'files': s3.uploaded_files - files, 'bytes': s3.uploaded_bytes - size,
+            'seconds': elapsed,
+            'calls': {name: sum(client.calls.values()) - calls[name] for name, client in clients.items()}}
+
+
+def child(source_type, sources, files, size_kb, dispatch):
+    # The local servers take any request rate
+    clients = fakes.install({'consumer_mode': 'drain', 'safety_margin': '1', 'dispatch': dispatch})
+    http_url = fakes.start_http(files, size_kb * 1024)
+    ftp_url = ''
+    if 'FTP' in source_type:
+        ftp_url = fakes.start_ftp(tempfile.mkdtemp(), [f's{n}' for n in range(sources)], files, size_kb * 1024)
+    clients['s3'].store('sources.csv', source_rows(source_type, sources, http_url, ftp_url))
+
+    import data_harvester
+    import data_downloader
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    first = run_pass(clients, data_harvester, data_downloader)
+    repeat = run_pass(clients, data_harvester, data_downloader)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'first': first, 'repeat': repeat, 'peak_mb': (peak - baseline) / 1024,
+                      'api_calls': fakes.api_calls(clients)}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sources', type=int, default=20)
+    parser.add_argument('--files', type=int, default=20)
+    parser.add_argument('--size', type=int, default=64, help='file size in KB')
+    parser.add_argument('--types', default=','.join(TYPES))
+    parser.add_argument('--verbose', action='store_true', help='print the API calls per operation')
+    parser.add_argument('--dispatch', default='inline', choices=['inline', 'fanout'])
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args.child, args.sources, args.files, args.size, args.dispatch)
+
+    print(f'{"TYPE":<16} {"pass":<7} {"sources/s":>10} {"files/s":>9} {"MB/s":>8} {"files":>6} {"seconds":>8} '
+          f'{"peak MB":>8} {"S3":>6} {"SQS":>6} {"SNS":>4}')
+    for source_type in args.types.split(','):
+        if 'FTP' in source_type:
+            try:
+                import pyftpdlib
+            except ImportError:
+                print(f'{source_type:<16} skipped, pyftpdlib is not installed')
+                continue
+        command = [sys.executable, __file__, '--child', source_type, '--sources', str(args.sources),
+                   '--files', str(args.files), '--size', str(args.size), '--dispatch', args.dispatch]
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        for name in ('first', 'repeat'):
+            r = result[name]
+            seconds = max(r['seconds'], 1e-9)
+            print(f'{source_type:<16} {name:<7} {r["sources"] / seconds:>10.1f} {r["files"] / seconds:>9.1f} '
+                  f'{r["bytes"] / 1024 / 1024 / seconds:>8.2f} {r["files"]:>6} {r["seconds"]:>8.2f} '
+                  f'{format(result["peak_mb"], ".1f") if name == "first" else "":>8} '
+                  f'{r["calls"]["s3"]:>6} {r["calls"]["sqs"]:>6} {r["calls"]["sns"]:>4}')
+        if args.verbose:
+            print(json.dumps(result['api_calls'], indent=2))
+
+
+if __name__ == '__main__':
+    main()
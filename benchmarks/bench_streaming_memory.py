@@ -0,0 +1,96 @@
+# Peak memory of data_downloader.download_upload as the file size grows.
+#
+# Each file size is measured in a fresh subprocess (ru_maxrss only ever grows),
+# the file is served from a local HTTP server and S3 is replaced by a client
+# that discards the uploaded bodies. With streaming uploads the peak RSS should
+# stay flat at roughly interpreter + one part, whatever the file size.
+# The script exits with status 1 when the growth of a size goes over part_size
+# (the ceiling of a single file) plus the tolerance, which covers the modules
+# imported by the first transfer.
+#
+# Usage: python benchmarks/bench_streaming_memory.py [--tolerance MB] [size_mb ...]
+
+import http.server
+import resource
+import subprocess
+import sys
+import threading
+
+import fakes
+
+
+class DiscardS3:
+    '''S3 stand-in that keeps nothing but the call count'''
+
+    def __init__(self):
+        self.calls = 0
+
+    def __getattr__(self, name):
+        def call(**kwargs):
+            self.calls += 1
+            return {'UploadId': 'bench', 'ETag': '"bench"'}
+        return call
+
+
+class ZeroHandler(http.server.BaseHTTPRequestHandler):
+    '''Serve /<size_in_bytes> as that many zero bytes, written in 1MB chunks'''
+
+    def do_GET(self):
+        size = int(self.path.strip('/'))
+        self.send_response(200)
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        chunk = b'\0' * (1024 * 1024)
+        while size > 0:
+            self.wfile.write(chunk[:size])
+            size -= len(chunk)
+
+    def log_message(self, *args):
+        pass
+
+
+def measure(size_mb):
+    # The downloader imports the shared modules of common/ as well
+    fakes.environment()
+    import data_downloader
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ZeroHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    data_downloader.s3 = DiscardS3()
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    data_downloader.download_upload(f'http://127.0.0.1:{server.server_port}/{size_mb * 1024 * 1024}', 'bench')
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    server.shutdown()
+    print(f'{size_mb} {baseline} {peak} {data_downloader.part_size}')
+
+
+def main(sizes, tolerance_mb):
+    '''
+    Returns:
+      bool: whether the growth of every size stayed under the ceiling
+    '''
+    print(f'{"size MB":>8} {"baseline MB":>12} {"peak MB":>8} {"growth MB":>10} {"limit MB":>9}')
+    flat = True
+    for size_mb in sizes:
+        out = subprocess.run([sys.executable, __file__, '--child', str(size_mb)],
+                             check=True, capture_output=True, text=True).stdout.split()
+        baseline, peak = int(out[1]) / 1024, int(out[2]) / 1024
+        limit = int(out[3]) / 1024 / 1024 + tolerance_mb
+        over = peak - baseline > limit
+        flat = flat and not over
+        print(f'{size_mb:>8} {baseline:>12.1f} {peak:>8.1f} {peak - baseline:>10.1f} {limit:>9.1f}'
+              f'{"  OVER" if over else ""}')
+    return flat
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        measure(int(sys.argv[2]))
+    else:
+        args = sys.argv[1:]
+        tolerance_mb = 16
+        if args[:1] == ['--tolerance']:
+            tolerance_mb, args = float(args[1]), args[2:]
+        if not main([int(s) for s in args] or [1, 16, 64, 256], tolerance_mb):
+            print('Peak memory grew over the limit')
+            sys.exit(1)
@@ -0,0 +1,328 @@
+# Local stand-ins for the AWS clients and the market operator sites used by the benchmarks.
+#
+# install() replaces boto3.client so the lambdas get the fake clients when they create theirs.
+# Every fake counts its API calls per operation.
+
+import collections
+import hashlib
+import http.server
+import io
+import itertools
+import os
+import sys
+import threading
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Objects up to this size keep their body (source csv, manifests, ...), bigger ones only their size
+MAX_KEPT_BODY = 256 * 1024
+
+
+def client_error(code, operation):
+    from botocore.exceptions import ClientError
+    return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+
+class FakeClient(object):
+    '''Base of the fakes, counts the calls of each operation'''
+
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+
+    @property
+    def exceptions(self):
+        import botocore.exceptions
+        return botocore.exceptions
+
+    def count(self, operation):
+        with self.lock:
+            self.calls[operation] += 1
+
+
+class FakeS3(FakeClient):
+    '''In-memory S3 with ETags, conditional gets and puts, and multipart uploads'''
+
+    def __init__(self):
+        super().__init__()
+        self.objects = {}
+        self.uploads = {}
+        self.ids = itertools.count()
+        self.uploaded_files = 0
+        self.uploaded_bytes = 0
+
+    def uploaded(self, key, size):
+        # Market data files, not the manifests and other json bookkeeping objects
+        if key.startswith('POC2/') and not key.endswith('.json'):
+            self.uploaded_files += 1
+            self.uploaded_bytes += size
+
+    def store(self, key, body):
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        with self.lock:
+            self.objects[key] = {'Body': body if len(body) <= MAX_KEPT_BODY else None,
+                                 'ContentLength': len(body), 'ETag': etag}
+            self.uploaded(key, len(body))
+        return etag
+
+    def found(self, key, operation):
+        if key not in self.objects:
+            raise client_error('NoSuchKey', operation)
+        return self.objects[key]
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None, **kwargs):
+        self.count('get_object')
+        obj = self.found(Key, 'GetObject')
+        if IfNoneMatch and IfNoneMatch == obj['ETag']:
+            raise client_error('304', 'GetObject')
+        return {'Body': io.BytesIO(obj['Body'] or b''), 'ETag': obj['ETag'], 'ContentLength': obj['ContentLength']}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self.count('head_object')
+        obj = self.found(Key, 'HeadObject')
+        return {'ETag': obj['ETag'], 'ContentLength': obj['ContentLength']}
+
+    def put_object(self, Bucket, Key, Body=b'', IfMatch=None, IfNoneMatch=None, **kwargs):
+        self.count('put_object')
+        body = Body if isinstance(Body, bytes) else Body.read() if hasattr(Body, 'read') else Body.encode()
+        if IfMatch and self.objects.get(Key, {}).get('ETag') != IfMatch:
+            raise client_error('PreconditionFailed', 'PutObject')
+        if IfNoneMatch == '*' and Key in self.objects:
+            raise client_error('PreconditionFailed', 'PutObject')
+        return {'ETag': self.store(Key, body)}
+
+    def copy_object(self, Bucket, Key, CopySource, **kwargs):
+        self.count('copy_object')
+        with self.lock:
+            self.objects[Key] = dict(self.found(CopySource['Key'], 'CopyObject'))
+        return {}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self.count('delete_object')
+        with self.lock:
+            self.objects.pop(Key, None)
+        return {}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self.count('create_multipart_upload')
+        upload_id = str(next(self.ids))
+        with self.lock:
+            self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        self.count('upload_part')
+        with self.lock:
+            # Only the size and digest of a part are kept
+            self.uploads[UploadId][PartNumber] = (len(Body), hashlib.md5(Body).hexdigest())
+        return {'ETag': f'"{self.uploads[UploadId][PartNumber][1]}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        self.count('complete_multipart_upload')
+        with self.lock:
+            parts = self.uploads.pop(UploadId)
+            size = sum(parts[p['PartNumber']][0] for p in MultipartUpload['Parts'])
+            self.objects[Key] = {'Body': None, 'ContentLength': size, 'ETag': f'"{UploadId}-{len(parts)}"'}
+            self.uploaded(Key, size)
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self.count('abort_multipart_upload')
+        with self.lock:
+            self.uploads.pop(UploadId, None)
+        return {}
+
+
+class FakeSQS(FakeClient):
+    '''In-memory queue, received messages are in flight until deleted or released'''
+
+    def __init__(self):
+        super().__init__()
+        self.queue = collections.deque()
+        self.in_flight = {}
+        self.receipts = itertools.count()
+        # Receives of each message body, the ApproximateReceiveCount of SQS
+        self.receives = collections.Counter()
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        self.count('send_message')
+        with self.lock:
+            self.queue.append(MessageBody)
+        return {}
+
+    def send_message_batch(self, QueueUrl, Entries, **kwargs):
+        self.count('send_message_batch')
+        with self.lock:
+            self.queue.extend(entry['MessageBody'] for entry in Entries)
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, **kwargs):
+        self.count('receive_message')
+        messages = []
+        with self.lock:
+            while self.queue and len(messages) < MaxNumberOfMessages:
+                receipt = str(next(self.receipts))
+                self.in_flight[receipt] = self.queue.popleft()
+                self.receives[self.in_flight[receipt]] += 1
+                messages.append({'ReceiptHandle': receipt, 'Body': self.in_flight[receipt],
+                                 'Attributes': {'ApproximateReceiveCount': str(self.receives[self.in_flight[receipt]])}})
+        return {'Messages': messages} if messages else {}
+
+    def delete_message(self, QueueUrl, ReceiptHandle, **kwargs):
+        self.count('delete_message')
+        with self.lock:
+            self.in_flight.pop(ReceiptHandle, None)
+        return {}
+
+    def delete_message_batch(self, QueueUrl, Entries, **kwargs):
+        self.count('delete_message_batch')
+        with self.lock:
+            for entry in Entries:
+                self.in_flight.pop(entry['ReceiptHandle'], None)
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+    def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout, **kwargs):
+        self.count('change_message_visibility')
+        if VisibilityTimeout == 0:
+            self.release(ReceiptHandle)
+        return {}
+
+    def change_message_visibility_batch(self, QueueUrl, Entries, **kwargs):
+        self.count('change_message_visibility_batch')
+        for entry in Entries:
+            if entry['VisibilityTimeout'] == 0:
+                self.release(entry['ReceiptHandle'])
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+    def release(self, receipt):
+        with self.lock:
+            if receipt in self.in_flight:
+                self.queue.append(self.in_flight.pop(receipt))
+
+
+class FakeSNS(FakeClient):
+    def __init__(self):
+        super().__init__()
+        self.published = []
+
+    def publish(self, **kwargs):
+        self.count('publish')
+        self.published.append(kwargs)
+        return {}
+
+
+class FakeLambda(FakeClient):
+    def __init__(self):
+        super().__init__()
+        self.invocations = []
+
+    def invoke(self, **kwargs):
+        self.count('invoke')
+        self.invocations.append(kwargs)
+        return {'StatusCode': 202}
+
+
+class FakeContext(object):
+    '''Lambda context with a deadline'''
+
+    def __init__(self, seconds=900):
+        import time
+        self.time = time
+        self.deadline = time.monotonic() + seconds
+        self.log_stream_name = 'bench'
+        self.function_name = 'bench'
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - self.time.monotonic()) * 1000)
+
+
+def environment(env=None):
+    '''Set the environment of the lambdas and put them on the path, without importing boto3'''
+    os.environ.update({'queue_name': 'bench', 'source_bucket': 'bench-sources', 'source_key': 'sources.csv',
+                       'interval': 'bench', 'AWS_DEFAULT_REGION': 'ap-southeast-2'})
+    os.environ.update(env or {})
+    for directory in ('common', 'data-harvester', 'data-downloader'):
+        if os.path.join(ROOT, directory) not in sys.path:
+            sys.path.insert(0, os.path.join(ROOT, directory))
+
+
+def install(env=None):
+    '''
+    Make boto3.client return the fakes, set the environment of the lambdas and put them on the path
+    Returns:
+      dict: service name -> fake client
+    '''
+    import boto3
+    clients = {'s3': FakeS3(), 'sqs': FakeSQS(), 'sns': FakeSNS(), 'lambda': FakeLambda()}
+    boto3.client = lambda service, *args, **kwargs: clients[service]
+    environment(env)
+    return clients
+
+
+def api_calls(clients):
+    '''Total API calls of every fake, with the breakdown per operation'''
+    return {name: dict(client.calls) for name, client in clients.items() if client.calls}
+
+
+class MarketSite(http.server.BaseHTTPRequestHandler):
+    '''
+    Market operator stand-in: /<source>/ is a listing page of file_count links,
+    /<source>/<file> a file of file_size bytes with a fixed Last-Modified
+    '''
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    file_count = 10
+    body = b''
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) == 1:
+            body = ''.join(f'<a href="{parts[0]}_{n}.csv">{parts[0]}_{n}.csv</a><br>\n'
+                           for n in range(self.file_count))
+            body = f'<html><body><pre>{body}</pre></body></html>'.encode()
+        else:
+            body = self.body
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Last-Modified', 'Mon, 01 Jan 2024 00:00:00 GMT')
+        self.end_headers()
+        if self.command == 'GET':
+            self.wfile.write(body)
+
+    do_HEAD = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+def start_http(file_count, file_size):
+    '''Start the HTTP stand-in, returns its base url'''
+    MarketSite.file_count = file_count
+    MarketSite.body = (b'2024/01/01 00:00:00,DUID,1.234\n' * (file_size // 31 + 1))[:file_size]
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), MarketSite)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}/'
+
+
+def start_ftp(root, sources, file_count, file_size):
+    '''
+    Start the FTP stand-in (needs pyftpdlib) serving <root>/<source>/<source>_<n>.csv, returns its base url
+    '''
+    import logging
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+
+    body = (b'2024/01/01 00:00:00,DUID,1.234\n' * (file_size // 31 + 1))[:file_size]
+    for source in sources:
+        os.makedirs(os.path.join(root, source), exist_ok=True)
+        for n in range(file_count):
+            with open(os.path.join(root, source, f'{source}_{n}.csv'), 'wb') as f:
+                f.write(body)
+    logging.getLogger('pyftpdlib').setLevel(logging.ERROR)
+    authorizer = DummyAuthorizer()
+    authorizer.add_anonymous(root)
+    handler = type('BenchFTPHandler', (FTPHandler,), {'authorizer': authorizer})
+    server = ThreadedFTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'ftp://127.0.0.1:{server.address[1]}/'
@@ -0,0 +1,30 @@
+# @Author: Dex
+# @Email: ykydxt@gmail.com
+
+import threading
+
+'''
+boto3 clients created on first use instead of at import time, shared by the harvester and downloader lambdas.
+boto3 is only imported when the first client is needed, and a client is only created for the services
+an invocation actually calls, e.g. SNS only when there is an error to report. The clients are module
+level, so they are kept for the warm invocations of the lambda container.
+'''
+
+lock = threading.Lock()
+
+class LazyClient(object):
+    '''
+    Stand-in for a boto3 client, the client is created on the first attribute access
+    '''
+    def __init__(self, service):
+        self.service = service
+        self.client = None
+
+    def __getattr__(self, name):
+        if self.client is None:
+            # Creating clients of the default session is not thread safe
+            with lock:
+                if self.client is None:
+                    import boto3
+                    self.client = boto3.client(self.service)
+        return getattr(self.client, name)
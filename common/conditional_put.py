@@ -0,0 +1,52 @@
+# @Author: Dex
+# @Email: ykydxt@gmail.com
+
+import json
+import time
+import random
+
+'''
+Read-modify-write of small json objects in S3 written concurrently by several invocations, shared by
+the harvester and downloader lambdas (watermarks, source status, manifests).
+An object is only written if it has not changed since it was read (If-Match its ETag, If-None-Match *
+when it did not exist). On a conflict it is read again and the change is applied to the new version.
+'''
+
+# Error codes of a put whose condition failed, or that raced another conditional put
+CONFLICT_CODES = ('412', 'PreconditionFailed', '409', 'ConditionalRequestConflict')
+
+def update_json(s3, bucket, key, etag, content, change, reload, attempts=5, backoff=0):
+    '''
+    Apply a change to a json object with conditional puts
+    Args:
+      s3 (boto3 client): the s3 client
+      bucket (string): the bucket of the object
+      key (string): the key of the object
+      etag (string): the ETag of the object as last read, None if it did not exist
+      content (object): the content of the object as last read
+      change (function): takes the content and returns the new content, None if there is nothing to write
+      reload (function): reads the object again and returns (etag, content)
+      attempts (int, optional): the number of conditional writes tried
+      backoff (float, optional): the seconds of the longest random wait before reading the object again,
+                                 doubled at every attempt, no wait by default
+    Returns:
+      tuple: (etag, content) of the object once changed, None if it changed under every attempt
+    '''
+    for attempt in range(attempts):
+        updated = change(content)
+        if updated is None:
+            return etag, content
+        condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+        try:
+            response = s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(updated).encode('utf-8'), **condition)
+        except s3.exceptions.ClientError as e:
+            if e.response['Error']['Code'] not in CONFLICT_CODES:
+                raise
+            print(f'{key} changed, retrying: {e}')
+        else:
+            return response['ETag'], updated
+        if backoff:
+            # Spread the writers of the same object apart
+            time.sleep(random.uniform(0, backoff * 2 ** attempt))
+        etag, content = reload()
+    return None
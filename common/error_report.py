@@ -0,0 +1,35 @@
+# @Author: Dex
+# @Email: ykydxt@gmail.com
+
+import json
+
+'''
+Report of invalid sources to developers, shared by the harvester (rows that are not valid sources)
+and the downloader (sources failing to download). The sources are labelled Active: 2 in the source
+registry, so they are not harvested again until their row is fixed, and one SNS notification lists them.
+'''
+
+TOPIC_ARN = 'arn:aws:sns:ap-southeast-2:547051082101:dex_test'
+MAX_SNS_MESSAGE = 256 * 1024
+
+def report(registry, sns, errors, sender):
+    '''
+    Label the sources of errors as Active: 2 and send one SNS notification listing them
+    Args:
+      registry (SourceRegistry): the registry of the source csv file
+      sns (boto3 client): the sns client
+      errors (list): {"ID", "URL", "REASON"} of every invalid source
+      sender (string): the lambda reporting the errors, in the subject of the notification
+    '''
+    try:
+        registry.set_status([e['ID'] for e in errors], 2)
+    except Exception as e:
+        print(f'Error when modifying source status: {e}')
+    msg = json.dumps({"MESSAGE": "The URLs in the source file should has been labelled as Active: 2", "ERRORS": errors}, indent=2)
+    if len(msg.encode('utf-8')) > MAX_SNS_MESSAGE:
+        # Keep the IDs of every source and drop the details that do not fit
+        msg = json.dumps({"MESSAGE": "The URLs in the source file should has been labelled as Active: 2", "IDS": [e['ID'] for e in errors]})
+    sns.publish(TopicArn=TOPIC_ARN,
+                Message=msg[:MAX_SNS_MESSAGE],
+                Subject=f'{len(errors)} errors from {sender}!')
+    print(f"SNS topic sent for {len(errors)} errors")
@@ -0,0 +1,148 @@
+# @Author: Dex
+# @Email: ykydxt@gmail.com
+
+import csv
+import hashlib
+import json
+from conditional_put import update_json
+
+'''
+Registry of the sources in the source csv file, shared by the harvester and downloader lambdas.
+The buildspec of each lambda copies this file next to the lambda code.
+
+The parsed csv file is cached in the lambda container and revalidated with its ETag, so a warm
+invocation costs one conditional GET. Status changes are not written into the csv file, they go to
+a small status object next to it (<source_key>.status.json) with conditional writes. A status applies
+until the row of the source is edited in the csv file, so fixing a source in the csv file reactivates it.
+'''
+
+# Registries cached in the lambda container, keyed by (bucket, key) of the source csv file
+registries = {}
+
+def get_registry(s3, bucket, key):
+    '''
+    Get the registry of a source csv file, revalidated against S3
+    Args:
+      s3 (boto3 client): the s3 client
+      bucket (string): the bucket of the source csv file
+      key (string): the key of the source csv file
+    '''
+    registry = registries.get((bucket, key))
+    if registry is None:
+        registry = registries[(bucket, key)] = SourceRegistry(s3, bucket, key)
+    registry.refresh()
+    return registry
+
+def row_hash(source):
+    '''
+    Fingerprint of a csv row, used to know whether the row was edited after a status change
+    '''
+    return hashlib.sha1(','.join(source).encode('utf-8')).hexdigest()
+
+class SourceRegistry(object):
+    '''
+    The sources of a source csv file indexed by ID and interval.
+    A source is the list of the columns of its row, column 4 "Active" reflects the status object.
+    '''
+    def __init__(self, s3, bucket, key):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.status_key = f'{key}.status.json'
+        self.etag = None
+        self.status_etag = None
+        self.rows = []
+        self.status = {}
+        self.by_id = {}
+        self.by_interval = {}
+
+    def conditional_get(self, key, etag):
+        '''
+        Get an object unless its ETag is still the cached one
+        Returns:
+          tuple: (etag, body), body is None if the object is not modified, (None, None) if it does not exist
+        '''
+        kwargs = {'IfNoneMatch': etag} if etag else {}
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=key, **kwargs)
+        except self.s3.exceptions.ClientError as e:
+            code = e.response['Error']['Code']
+            if code in ('304', 'NotModified'):
+                return etag, None
+            if code in ('404', 'NoSuchKey'):
+                return None, None
+            raise
+        return response['ETag'], response['Body'].read().decode('utf-8')
+
+    def refresh(self):
+        '''
+        Reload the csv file and the status object if they changed since the last load
+        '''
+        etag, source_data = self.conditional_get(self.key, self.etag)
+        status_etag, status_data = self.conditional_get(self.status_key, self.status_etag)
+        if source_data is not None:
+            self.etag = etag
+            self.rows = [source for source in csv.reader(source_data.splitlines()) if len(source) > 9]
+        if status_etag is None:
+            self.status = {}
+        elif status_data is not None:
+            self.status = json.loads(status_data)
+        self.status_etag = status_etag
+        if source_data is not None or status_data is not None or status_etag is None:
+            self.index()
+
+    def index(self):
+        '''
+        Rebuild the indexes, applying the status object over the csv file
+        '''
+        self.by_id = {}
+        self.by_interval = {}
+        for row in self.rows:
+            source = list(row)
+            status = self.status.get(source[0])
+            if status and status['row'] == row_hash(row):
+                source[4] = status['Active']
+            self.by_id[source[0]] = source
+            self.by_interval.setdefault(source[2], []).append(source)
+
+    def get(self, source_id):
+        '''
+        Get a source by its ID, None if there is no such source
+        '''
+        return self.by_id.get(source_id)
+
+    def active(self, interval):
+        '''
+        Get the active sources of an interval
+        '''
+        # source[4] belongs to header "Active",value 0 means inactive, 1 means active, 2 means something wrong with the source and needs fix
+        return [source for source in self.by_interval.get(interval, []) if source[4] == "1"]
+
+    def set_status(self, source_ids, active, attempts=5):
+        '''
+        Change the "Active" flag of sources with a conditional write of the status object.
+        If another invocation wrote the status object in between, it is reloaded and the change retried.
+        Args:
+          source_ids (list): the IDs of the sources
+          active (string): the new value of "Active"
+          attempts (int, optional): the number of conditional writes tried
+        '''
+        def change(current):
+            # The rows as last refreshed, the row of a source may have been edited since
+            rows = {row[0]: row for row in self.rows}
+            status = dict(current)
+            for source_id in source_ids:
+                if source_id in rows:
+                    status[source_id] = {'Active': str(active), 'row': row_hash(rows[source_id])}
+            return status
+
+        def reload():
+            self.refresh()
+            return self.status_etag, self.status
+
+        written = update_json(self.s3, self.bucket, self.status_key, self.status_etag, self.status,
+                              change, reload, attempts)
+        if written is None:
+            raise RuntimeError(f'Could not update the status of {source_ids} after {attempts} attempts')
+        self.status_etag, self.status = written
+        self.index()
@@ -0,0 +1,49 @@
+# @Author: Dex
+# @Email: ykydxt@gmail.com
+
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+Batched sending of SQS messages, shared by the harvester (source tasks) and the downloader (FILE tasks).
+Messages go 10 per send_message_batch call with the calls sent in parallel, and the failed entries
+of a call are retried once.
+'''
+
+def send_batch(sqs, queue_url, batch):
+    '''
+    Send up to 10 messages with one send_message_batch call, failed entries are retried once
+    Args:
+      sqs (boto3 client): the sqs client
+      queue_url (string): the url of the queue
+      batch (list): (index, body) pairs of the messages
+    Returns:
+      list: the indexes of the messages not sent
+    '''
+    entries = [{'Id': str(index), 'MessageBody': body} for index, body in batch]
+    failed = sqs.send_message_batch(QueueUrl=queue_url, Entries=entries).get('Failed', [])
+    if failed:
+        failed_ids = set(f['Id'] for f in failed)
+        retry = [entry for entry in entries if entry['Id'] in failed_ids]
+        failed = sqs.send_message_batch(QueueUrl=queue_url, Entries=retry).get('Failed', [])
+        for f in failed:
+            print(f'Error when sending message: {f}')
+    return [int(f['Id']) for f in failed]
+
+def send_messages(sqs, queue_url, messages, workers=8):
+    '''
+    Send messages to SQS in batches of 10, with the batches sent in parallel
+    Args:
+      sqs (boto3 client): the sqs client
+      queue_url (string): the url of the queue
+      messages (list): the message bodies
+      workers (int, optional): the number of send_message_batch calls sent at once
+    Returns:
+      set: the indexes of the messages not sent
+    '''
+    indexed = list(enumerate(messages))
+    batches = [indexed[start:start + 10] for start in range(0, len(indexed), 10)]
+    if not batches:
+        return set()
+    with ThreadPoolExecutor(max_workers=min(workers, len(batches))) as pool:
+        failed = pool.map(lambda batch: send_batch(sqs, queue_url, batch), batches)
+        return set(index for indexes in failed for index in indexes)
@@ -0,0 +1,145 @@
+# @Author: Dex
+# @Email: ykydxt@gmail.com
+
+import json
+import urllib.parse
+
+'''
+The tasks sent from the harvester to the downloader through SQS, shared by both lambdas.
+A task is validated once, when the harvester builds it from the source csv file, and travels as a
+compact json array (schema tag first, trailing empty fields dropped) instead of an object with a
+key per field. The downloader decodes it without validating it again, and still accepts the json
+objects sent before this schema.
+'''
+
+SOURCE_SCHEMA = 'T1'
+FILE_SCHEMA = 'F2'
+# The FILE tasks sent with the type of their source after the ID
+FILE_SCHEMA_V1 = 'F1'
+FILE_TYPE = 'FILE'
+
+class TaskError(ValueError):
+    '''
+    A row of the source csv file that cannot make a task
+    '''
+
+class Task(object):
+    '''
+    The task of a source for one run, period is the start of the run in the local time of the source
+    '''
+    __slots__ = ('id', 'type', 'url', 'pattern', 'utc', 'period', 'storage', 'compression')
+
+    def __init__(self, id, type, url, pattern='', utc='0', period='', storage='', compression=''):
+        self.id = id
+        self.type = type
+        self.url = url
+        self.pattern = pattern
+        self.utc = utc
+        self.period = period
+        self.storage = storage
+        self.compression = compression
+
+    @classmethod
+    def from_row(cls, row):
+        '''
+        Build and validate the task template of a row of the source csv file,
+        STORAGE and COMPRESSION are optional columns after UTC
+        Raises:
+          TaskError: the row is not a valid source
+        '''
+        if len(row) < 10:
+            raise TaskError(f'expected at least 10 columns, got {len(row)}')
+        task = cls(row[0].strip(), row[7].strip(), row[1].strip(), row[8].strip(), row[9].strip() or '0', '',
+                   row[10].strip() if len(row) > 10 else '', row[11].strip() if len(row) > 11 else '')
+        task.validate()
+        return task
+
+    def validate(self):
+        if not self.id:
+            raise TaskError('empty ID')
+        if not self.type:
+            raise TaskError(f'{self.id}: empty TYPE')
+        parts = urllib.parse.urlsplit(self.url)
+        if not parts.scheme or not parts.netloc:
+            raise TaskError(f'{self.id}: invalid URL {self.url!r}')
+        try:
+            int(self.utc)
+        except ValueError:
+            raise TaskError(f'{self.id}: invalid UTC offset {self.utc!r}')
+        try:
+            # The templates are formatted with the date tokens at every run
+            self.url.format(**DUMMY_TOKENS)
+            self.pattern.format(**DUMMY_TOKENS)
+        except (KeyError, IndexError, ValueError) as e:
+            raise TaskError(f'{self.id}: invalid template in URL or PATTERN: {e}')
+
+    @property
+    def offset(self):
+        return int(self.utc)
+
+    def fields(self):
+        return [self.id, self.type, self.url, self.pattern, self.utc, self.period, self.storage, self.compression]
+
+    def encode(self):
+        return encode(SOURCE_SCHEMA, self.fields())
+
+class FileTask(object):
+    '''
+    The task of one file of a fanned out listing
+    '''
+    __slots__ = ('id', 'url', 's3_path', 'known', 'remote', 'manifest', 'period', 'storage', 'compression')
+
+    type = FILE_TYPE
+
+    def __init__(self, id, url, s3_path, known=None, remote=None, manifest=False,
+                 period='', storage='', compression=''):
+        self.id = id
+        self.url = url
+        self.s3_path = s3_path
+        self.known = known
+        self.remote = remote
+        self.manifest = manifest
+        self.period = period
+        self.storage = storage
+        self.compression = compression
+
+    def fields(self):
+        return [self.id, self.url, self.s3_path, self.known, self.remote, self.manifest,
+                self.period, self.storage, self.compression]
+
+    def encode(self):
+        return encode(FILE_SCHEMA, self.fields())
+
+# Values of every date token, to check the templates of a source
+DUMMY_TOKENS = dict.fromkeys(['year', 'month', 'lastmonth', 'lastmonth_year', 'day', 'hour', 'minute'], '00')
+
+def encode(schema, fields):
+    '''
+    The compact json of a task, trailing fields with their default value are dropped
+    '''
+    while fields and fields[-1] in ('', None, False):
+        fields.pop()
+    return json.dumps([schema] + fields, separators=(',', ':'))
+
+def decode(body):
+    '''
+    Read a task from a message body
+    Returns:
+      Task or FileTask
+    '''
+    content = json.loads(body)
+    if isinstance(content, list):
+        if content[0] == FILE_SCHEMA:
+            return FileTask(*content[1:])
+        if content[0] == FILE_SCHEMA_V1:
+            return FileTask(content[1], *content[3:])
+        if content[0] == SOURCE_SCHEMA:
+            return Task(*content[1:])
+        raise TaskError(f'unknown task schema {content[0]!r}')
+    # A message sent before the compact schema
+    if content.get('TYPE') == FILE_TYPE:
+        return FileTask(content['ID'], content['URL'], content['S3_PATH'],
+                        content.get('KNOWN'), content.get('REMOTE'), content.get('MANIFEST', False),
+                        content.get('PERIOD', ''), content.get('STORAGE', ''), content.get('COMPRESSION', ''))
+    return Task(content['ID'], content['TYPE'], content['URL'], content.get('PATTERN') or '', content.get('UTC') or '0',
+                content.get('PERIOD', ''), content.get('STORAGE', ''), content.get('COMPRESSION', ''))
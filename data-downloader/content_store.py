@@ -0,0 +1,137 @@
+# @Author: Dex
+# @Email: ykydxt@gmail.com
+
+import os
+import zlib
+import uuid
+import datetime
+from task_schema import Task
+
+'''
+Storage plan of the files of a source: where the downloader puts them and how they are compressed.
+In "path" storage a file goes to its key under POC2/<TYPE>/. In "cas" storage a file is stored once
+under the sha256 of its content (POC2/OBJECTS/<sha256>) and a small pointer object keyed by source
+ID and date (POC2/POINTERS/<ID>/<date>/<file name>.json) records which object it is, so the same
+content under different names or sources is stored once and names of different sources do not collide.
+Text files can be compressed with gzip or zstd while they are streamed, zstd needs the zstandard
+package and falls back to gzip without it.
+
+A source chooses with the optional STORAGE ("path" or "cas") and COMPRESSION ("none", "gzip" or "zstd")
+columns of the source csv file, the environment gives the default.
+
+Environment Variable：
+    storage (string, optional): the default storage, "path" by default
+    compression (string, optional): the default compression, "none" by default
+'''
+
+default_storage = os.environ.get('storage', 'path')
+default_compression = os.environ.get('compression', 'none')
+
+SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+TEXT_EXTENSIONS = ('.csv', '.txt', '.tsv', '.json', '.xml', '.dat', '.htm', '.html')
+TEXT_TYPES = ('text/', 'application/json', 'application/xml', 'application/csv')
+
+def compressor(codec):
+    '''
+    Get a streaming compressor with the compress/flush interface of zlib
+    Args:
+      codec (string): "gzip" or "zstd"
+    '''
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor().compressobj()
+    # wbits 31 writes the gzip header and trailer
+    return zlib.compressobj(6, zlib.DEFLATED, 31)
+
+class CompressingReader(object):
+    '''
+    Wrap a stream to read its content compressed
+    '''
+    def __init__(self, stream, codec, chunk_size=1024 * 1024):
+        self.stream = stream
+        self.compressor = compressor(codec)
+        self.chunk_size = chunk_size
+        self.buffer = b''
+        self.done = False
+
+    def read(self, size=-1):
+        while not self.done and (size < 0 or len(self.buffer) < size):
+            chunk = self.stream.read(self.chunk_size)
+            if chunk:
+                self.buffer += self.compressor.compress(chunk)
+            else:
+                self.buffer += self.compressor.flush()
+                self.done = True
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+class PrefixedReader(object):
+    '''
+    Read bytes already taken from a stream, then the rest of the stream
+    '''
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+
+    def read(self, size=-1):
+        if self.prefix:
+            if size < 0:
+                size = len(self.prefix)
+            data, self.prefix = self.prefix[:size], self.prefix[size:]
+            return data
+        return self.stream.read(size)
+
+class StoragePlan(object):
+    '''
+    The storage and compression of the files of one source
+    '''
+    def __init__(self, task):
+        '''
+        Args:
+          task (Task or FileTask): the task of the source
+        '''
+        self.source_id = task.id
+        self.storage = task.storage or default_storage
+        self.compression = task.compression or default_compression
+        if self.compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                print('zstandard is not installed, compressing with gzip')
+                self.compression = 'gzip'
+        self.date = task.period[:10] if task.period else datetime.datetime.utcnow().strftime('%Y-%m-%d')
+
+    @property
+    def content_addressed(self):
+        return self.storage == 'cas'
+
+    def codec(self, s3_path, content_type=None):
+        '''
+        The compression of a file, None for a file stored as it is
+        Args:
+          s3_path (string): the key of the file in s3 bucket
+          content_type (string, optional): the Content-Type of the file if known
+        '''
+        if self.compression not in SUFFIXES:
+            return None
+        name = s3_path.lower()
+        if name.endswith(TEXT_EXTENSIONS) or (content_type or '').lower().startswith(TEXT_TYPES):
+            return self.compression
+        return None
+
+    def path_key(self, s3_path, codec):
+        return s3_path + SUFFIXES.get(codec, '')
+
+    def object_key(self, sha256, codec):
+        return f'POC2/OBJECTS/{sha256[:2]}/{sha256}{SUFFIXES.get(codec, "")}'
+
+    def pointer_key(self, s3_path):
+        return f'POC2/POINTERS/{self.source_id}/{self.date}/{s3_path.rsplit("/", 1)[-1]}.json'
+
+    def staging_key(self):
+        return f'POC2/STAGING/{uuid.uuid4().hex}'
+
+# Files of sources without a plan are stored by path and not compressed
+PATH = StoragePlan(Task('', '', '', storage='path', compression='none'))
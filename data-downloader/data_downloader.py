@@ -1,205 +1,996 @@
 # @Author: Dex
 # @Email: ykydxt@gmail.com
 
-import boto3
-import botocore.vendored.requests
-import urllib
+import urllib.parse
+import hashlib
+import contextlib
 import fnmatch
 import json
 import os
-import csv
-from bs4 import BeautifulSoup
+import importlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from source_registry import get_registry
+from aws_clients import LazyClient
+from conditional_put import update_json
+from sqs_batch import send_messages
+import http_session
+import ftp_backend
+import link_extractor
+import instrumentation
+import content_store
+import host_guard
+import task_schema
+import error_report
+from task_schema import FileTask, FILE_TYPE
 
 '''
 Environment Variable：
     queue_name (string): the name of SQS queue
     source_bucket (string): the bucket of the source csv file
     source_key (string): the key of the source csv file
+    part_size (string, optional): the size in MB of each multipart upload part, 8 by default
+    max_workers (string, optional): the number of files transferred at once, 8 by default
+    host_limit (string, optional): the number of files transferred at once from the same host, 4 by default
+    http_timeout, http_retries (string, optional): see http_session.py
+    ftp_timeout, ftp_resumes (string, optional): see ftp_backend.py
+    storage, compression (string, optional): see content_store.py
+    host_rate, host_burst, breaker_failures, breaker_cooldown, guard_state (string, optional): see host_guard.py
+    link_parser (string, optional): "bs4" to parse listing pages with BeautifulSoup instead of the streaming scanner
+    metrics (string, optional): see instrumentation.py
+    consumer_mode (string, optional): "drain" to keep receiving messages until the safety margin is reached,
+                                      otherwise 5 messages are received per invocation
+    visibility_timeout (string, optional): the seconds a message stays invisible while its task runs, 300 by default
+    max_receives (string, optional): the maxReceiveCount of the redrive policy of the queue, 5 by default.
+                                     A task whose host is down is reported with handle_error at its last
+                                     receive instead of being deferred to the dead letter queue
+    safety_margin (string, optional): the seconds before the lambda timeout when draining stops, 60 by default
+    dispatch (string, optional): "fanout" to have LINKS, LINKS_OVERWRITE and FTP_FILES tasks only list the files
+                                 and enqueue one FILE task per file, transferred by any invocation.
+                                 Otherwise the files are transferred by the invocation listing them
+    fanout_threshold (string, optional): the number of files above which a listing is fanned out, 0 by default
+    plugins (string, optional): comma separated modules imported at start, which add source types with
+                                source_type and protocols with transport
 '''
 
-sqs = boto3.client('sqs')
-s3 = boto3.client('s3')
-sns = boto3.client('sns')
+sqs = LazyClient('sqs')
+s3 = LazyClient('s3')
+sns = LazyClient('sns')
 
 queue_url = f'https://sqs.ap-southeast-2.amazonaws.com/547051082101/{os.environ["queue_name"]}'
 
+# S3 rejects multipart parts smaller than 5MB (except the last one)
+MIN_PART_SIZE = 5 * 1024 * 1024
+part_size = max(int(os.environ.get('part_size', '8')) * 1024 * 1024, MIN_PART_SIZE)
+
+# Every worker holds at most one part in memory, so the ceiling is max_workers * part_size
+max_workers = int(os.environ.get('max_workers', '8'))
+host_limit = int(os.environ.get('host_limit', '4'))
+host_slots = {}
+host_slots_lock = threading.Lock()
+
+# Errors of the invocation, reported together by report_errors
+errors = []
+errors_lock = threading.Lock()
+
+link_parser = os.environ.get('link_parser', 'stream')
+
+consumer_mode = os.environ.get('consumer_mode', 'fixed')
+visibility_timeout = int(os.environ.get('visibility_timeout', '300'))
+safety_margin_ms = int(os.environ.get('safety_margin', '60')) * 1000
+max_receives = int(os.environ.get('max_receives', '5'))
+# ApproximateReceiveCount of the messages received by the invocation, keyed by receipt
+receive_counts = {}
+
+dispatch = os.environ.get('dispatch', 'inline')
+fanout_threshold = int(os.environ.get('fanout_threshold', '0'))
+
+# Receipts of finished messages, deleted 10 at a time with delete_message_batch
+pending_deletes = []
+pending_deletes_lock = threading.Lock()
+
+def flush_deletes():
+    '''
+    Delete the pending messages in SQS with delete_message_batch
+    '''
+    with pending_deletes_lock:
+        receipts = pending_deletes[:]
+        del pending_deletes[:]
+    for start in range(0, len(receipts), 10):
+        entries = [{'Id': str(n), 'ReceiptHandle': receipt} for n, receipt in enumerate(receipts[start:start + 10])]
+        response = sqs.delete_message_batch(QueueUrl=queue_url, Entries=entries)
+        for failed in response.get('Failed', []):
+            print(f'Error when deleting message: {failed}')
+        print(f'{len(response.get("Successful", []))} SQS Messages deleted')
+
+def delete_message(msg_receipt):
+    '''
+    Queue a finished message for deletion, the deletion is sent once 10 messages are pending.
+    The consumer loops flush the pending deletions after every task: a finished message is no longer
+    kept visible by a heartbeat, so it must not wait for later tasks past its visibility timeout.
+    Args:
+      msg_receipt (string): the receipt of the message from SQS
+    '''
+    with pending_deletes_lock:
+        pending_deletes.append(msg_receipt)
+        full = len(pending_deletes) >= 10
+    if full:
+        flush_deletes()
+
+class VisibilityHeartbeat(object):
+    '''
+    Keep extending the visibility timeout of messages while their tasks are running,
+    so a slow task is not handed over to another consumer
+    '''
+    def __init__(self, *msg_receipts):
+        self.msg_receipts = msg_receipts
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.done.wait(visibility_timeout / 2):
+            for start in range(0, len(self.msg_receipts), 10):
+                entries = [{'Id': str(n), 'ReceiptHandle': receipt, 'VisibilityTimeout': visibility_timeout}
+                           for n, receipt in enumerate(self.msg_receipts[start:start + 10])]
+                try:
+                    sqs.change_message_visibility_batch(QueueUrl=queue_url, Entries=entries)
+                except Exception as e:
+                    print(f'Error when extending visibility: {e}')
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.done.set()
+        self.thread.join()
+
+def defer_message(msg_receipt, seconds):
+    '''
+    Hide a message for a while instead of running its task now, SQS hands it over again afterwards
+    Args:
+      msg_receipt (string): the receipt of the message from SQS
+      seconds (float): the delay, capped at the 12 hours SQS allows
+    '''
+    try:
+        sqs.change_message_visibility(QueueUrl=queue_url, ReceiptHandle=msg_receipt,
+                                      VisibilityTimeout=int(min(max(seconds, 1), 43200)))
+    except Exception as e:
+        print(f'Error when deferring message: {e}')
+
+def remember_receives(messages):
+    '''
+    Keep the receive count of received messages, see defer_task
+    Args:
+      messages (list): the messages received from SQS, with the ApproximateReceiveCount attribute
+    '''
+    for message in messages:
+        receive_counts[message['ReceiptHandle']] = int(message.get('Attributes', {}).get('ApproximateReceiveCount', 1))
+
+def defer_task(task, msg_receipt, wait, reason, metrics=instrumentation.NOOP):
+    '''
+    Defer the message of a task whose host is down. A deferral takes a receive of the message, so at
+    its last receive before the redrive policy moves it to the dead letter queue, the task is reported
+    with handle_error instead of being deferred again.
+    Args:
+      task (Task or FileTask): the task of the message
+      msg_receipt (string): the receipt of the message from SQS
+      wait (float): the seconds to defer the message
+      reason (string or Exception): why the host is down
+      metrics (SourceMetrics, optional): the metrics of the task
+    '''
+    if receive_counts.get(msg_receipt, 1) >= max_receives:
+        metrics.set_outcome('error')
+        print(f'Not deferred: {task.id}, received {max_receives} times while its host is down')
+        handle_error(task.id, task.url, f'Host down for {max_receives} receives: {reason}', msg_receipt)
+    else:
+        metrics.set_outcome('deferred')
+        print(f'Deferred: {task.id} for {wait:.0f}s, {reason}')
+        defer_message(msg_receipt, wait)
+
+def host_outcome(e):
+    '''
+    Whether an exception counts as a failure of the host, and whether the host is throttling
+    Returns:
+      tuple: (failed, throttled)
+    '''
+    if isinstance(e, http_session.HTTPError):
+        return e.code >= 500 or e.code == 429, e.code in (429, 503)
+    if isinstance(e, host_guard.CircuitOpen):
+        return False, False
+    return http_session.connection_error(e) or ftp_backend.connection_error(e), False
+
+@contextlib.contextmanager
+def guarded(url):
+    '''
+    Take a token of the host of a url and record the outcome of the requests made in the block
+    Raises:
+      CircuitOpen: the circuit of the host is open
+    '''
+    guard = host_guard.get(url)
+    guard.acquire()
+    try:
+        yield
+    except Exception as e:
+        failed, throttled = host_outcome(e)
+        if failed:
+            guard.failure(throttled)
+        else:
+            # The host answered, the error is about the request
+            guard.success()
+        raise
+    else:
+        guard.success()
+
 def handle_error(e_id, e_url, e_message, msg_receipt):
     '''
     Handle the situation where there's something from with the source.
-    1. Modify the source csv file.
-    2. Send SNS nofication to developers
-    3. Delete the message(task) in SQS
+    1. Record the error, the errors of the invocation are reported together by report_errors
+    2. Delete the message(task) in SQS
     Args:
       e_id (string): the ID(in the source csv file) of the invalid source
       e_url (string): the URL of the invalid source
       e_message (string): The error message returned from the invalid source, sent to developers
       msg_receipt (string): the receipt of the message from SQS, used to delete the message
     '''
+    with errors_lock:
+        errors.append({"ID": e_id, "URL": e_url, "REASON": str(e_message)})
+    delete_message(msg_receipt)
+
+def report_errors():
+    '''
+    Report the errors recorded during the invocation
+    1. Label every invalid source as Active: 2 with a single conditional write of the source registry
+    2. Send one SNS nofication to developers listing all the invalid sources
+    '''
+    with errors_lock:
+        reported = errors[:]
+        del errors[:]
+    if not reported:
+        return
+    error_report.report(get_registry(s3, os.environ['source_bucket'], os.environ['source_key']), sns, reported,
+                        'Marketdata Downloader')
+
+def source_failed(task, e, msg_receipt, metrics=instrumentation.NOOP):
+    '''
+    Handle the error of a task. If the host of the source failed (connection error, 5xx, 429) the host
+    is down, not the source, so the message is deferred: until the host is tried again if its circuit is
+    open, with a backoff otherwise (see defer_task). An error about the source itself goes to handle_error.
+    Args:
+      task (Task): the task of the source
+      e (Exception): the error
+      msg_receipt (string): the receipt of the message from SQS
+      metrics (SourceMetrics, optional): the metrics of the task
+    '''
+    wait = host_guard.retry_after(task.url)
+    if not wait and host_outcome(e)[0]:
+        wait = host_guard.backoff(task.url)
+    if wait:
+        defer_task(task, msg_receipt, wait, e, metrics)
+    else:
+        metrics.set_outcome('error')
+        handle_error(task.id, task.url, e, msg_receipt)
+
+def read_part(stream, size):
+    '''
+    Read up to size bytes from a stream, a short read only happens at the end of the stream
+    Args:
+      stream (file-like object): the response of the target file
+      size (int): the number of bytes to read
+    '''
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+def stream_upload(stream, s3_path, metrics=instrumentation.NOOP):
+    '''
+    Upload a stream to s3 bucket part by part, so that at most one part is held in memory.
+    A stream smaller than one part is uploaded with a single put_object.
+    Args:
+      stream (file-like object): the response of the target file
+      s3_path (string): the key in s3 bucket
+      metrics (SourceMetrics, optional): the metrics of the task, reading is timed as download and S3 calls as upload
+    Returns:
+      int: the number of bytes uploaded
+    '''
+    with metrics.phase('download'):
+        data = read_part(stream, part_size)
+    if len(data) < part_size:
+        with metrics.phase('upload'):
+            s3.put_object(Bucket="dex.test", Key=s3_path, Body=data)
+        metrics.add_file(len(data))
+        return len(data)
+
+    with metrics.phase('upload'):
+        upload_id = s3.create_multipart_upload(Bucket="dex.test", Key=s3_path)['UploadId']
+    parts = []
+    size = 0
     try:
-        # Retrive the source csv file
-        source_data = s3.get_object(Bucket=os.environ['source_bucket'], Key=os.environ['source_key'])['Body'].read().decode("utf-8").splitlines(True)
-        csv_writer = csv.writer(open(f'/tmp/{os.environ["source_key"]}', 'w'))
-        sources = list(csv.reader(source_data))
-        for n, source in enumerate(sources):
-            # Modify the flag of invalid source to "2"
-            if source[0] == e_id:
-                sources[n][4] = 2
-            csv_writer.writerow(source)
-        s3.upload_file(f'/tmp/{os.environ["source_key"]}', 'dex.test', f'ttt/{os.environ["source_key"]}')
-    except Exception as e:
-        print(f'Error when modifying source file: {e}')
-    finally:
-        e_message = str(e_message).replace('"', "'")
-        msg = f'{{"ID": "{e_id}", "URL": "{e_url}", "REASON": "{e_message}"}}, "MESSAGE": "The URL in the source file should has been labelled as Active: 2 "'
-        sns.publish(TopicArn='arn:aws:sns:ap-southeast-2:547051082101:dex_test',
-                        Message=msg,
-                        Subject='Error from Marketdata Downloader!')
-        print("SNS topic sent")
-        sqs.delete_message(QueueUrl=queue_url,ReceiptHandle=msg_receipt)
-        print("Message in the SQS is deleted")
+        while data:
+            with metrics.phase('upload'):
+                part = s3.upload_part(Bucket="dex.test", Key=s3_path, UploadId=upload_id,
+                                      PartNumber=len(parts) + 1, Body=data)
+            parts.append({'ETag': part['ETag'], 'PartNumber': len(parts) + 1})
+            size += len(data)
+            with metrics.phase('download'):
+                data = read_part(stream, part_size)
+        with metrics.phase('upload'):
+            s3.complete_multipart_upload(Bucket="dex.test", Key=s3_path, UploadId=upload_id,
+                                         MultipartUpload={'Parts': parts})
+    except Exception:
+        # Do not leave orphaned parts behind, they are billed until aborted
+        s3.abort_multipart_upload(Bucket="dex.test", Key=s3_path, UploadId=upload_id)
+        raise
+    metrics.add_file(size)
+    return size
+
+class HashingReader(object):
+    '''
+    Wrap a stream to compute the size and sha256 of the content as it is read
+    '''
+    def __init__(self, stream):
+        self.stream = stream
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        chunk = self.stream.read(size)
+        self.sha256.update(chunk)
+        self.size += len(chunk)
+        return chunk
+
+def object_exists(key):
+    '''
+    Whether an object is in the s3 bucket
+    '''
+    try:
+        s3.head_object(Bucket="dex.test", Key=key)
+        return True
+    except s3.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+
+def store_content(reader, file_url, s3_path, plan=content_store.PATH, content_type=None, metrics=instrumentation.NOOP):
+    '''
+    Upload a file following the storage plan of its source, compressed on the fly if the plan says so.
+    With content addressed storage a file that fits in one part is hashed before it is uploaded and
+    not uploaded at all if its object exists, a bigger file is streamed to a staging key and copied
+    to its object once its hash is known. A pointer object then records the object of the file.
+    Args:
+      reader (HashingReader): the content of the file
+      file_url (string): the url of the file
+      s3_path (string): the key of the file in s3 bucket
+      plan (StoragePlan, optional): the storage plan of the source
+      content_type (string, optional): the Content-Type of the file if known
+      metrics (SourceMetrics, optional): the metrics of the task
+    Returns:
+      dict: 'object' the key of the stored object, 'stored_size' its size, 'compression' its codec
+    '''
+    codec = plan.codec(s3_path, content_type)
+    body = content_store.CompressingReader(reader, codec) if codec else reader
+    if not plan.content_addressed:
+        key = plan.path_key(s3_path, codec)
+        return {'object': key, 'stored_size': stream_upload(body, key, metrics), 'compression': codec}
+
+    with metrics.phase('download'):
+        data = read_part(body, part_size)
+    if len(data) < part_size:
+        # The whole file is read, its address is known before anything is uploaded
+        key = plan.object_key(reader.sha256.hexdigest(), codec)
+        with metrics.phase('upload'):
+            if not object_exists(key):
+                s3.put_object(Bucket="dex.test", Key=key, Body=data)
+                metrics.add_file(len(data))
+        stored = len(data)
+    else:
+        staging = plan.staging_key()
+        stored = stream_upload(content_store.PrefixedReader(data, body), staging, metrics)
+        key = plan.object_key(reader.sha256.hexdigest(), codec)
+        with metrics.phase('upload'):
+            try:
+                # copy_object handles objects up to 5GB
+                if not object_exists(key):
+                    s3.copy_object(Bucket="dex.test", Key=key, CopySource={'Bucket': "dex.test", 'Key': staging})
+            finally:
+                s3.delete_object(Bucket="dex.test", Key=staging)
+    pointer = {'source': plan.source_id, 'url': file_url, 'path': s3_path, 'object': key,
+               'sha256': reader.sha256.hexdigest(), 'size': reader.size, 'stored_size': stored, 'compression': codec}
+    with metrics.phase('upload'):
+        s3.put_object(Bucket="dex.test", Key=plan.pointer_key(s3_path), Body=json.dumps(pointer).encode('utf-8'))
+    return {'object': key, 'stored_size': stored, 'compression': codec}
 
+def load_manifest(source_id, metrics=instrumentation.NOOP):
+    '''
+    Retrieve the manifest of the files already ingested from a source
+    Args:
+      source_id (string): the ID(in the source csv file) of the source
+      metrics (SourceMetrics, optional): the metrics of the task
+    Returns:
+      dict: s3 key -> {'size', 'content_length', 'etag', 'last_modified', 'sha256', 'object', 'stored_size', 'compression'} of the file
+    '''
+    try:
+        with metrics.phase('manifest'):
+            body = s3.get_object(Bucket="dex.test", Key=f'POC2/MANIFEST/{source_id}.json')['Body'].read()
+    except s3.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return {}
+        raise
+    return json.loads(body.decode('utf-8'))
 
-def download_upload(file_url, s3_path):
+def merge_manifest(source_id, entries, attempts=5, metrics=instrumentation.NOOP, removed=()):
     '''
-    download file and upload it to s3 bucket
+    Add entries to the manifest of a source written concurrently by other invocations.
+    The manifest is written only if it has not changed since it was read, otherwise it is read again
+    and the entries are merged into the new version.
+    Args:
+      source_id (string): the ID(in the source csv file) of the source
+      entries (dict): s3 key -> manifest entry of the files uploaded
+      attempts (int, optional): the number of conditional writes tried
+      metrics (SourceMetrics, optional): the metrics of the task
+      removed (list, optional): the s3 keys of the entries to drop, files the source no longer lists
+    Returns:
+      bool: whether the entries were written
+    '''
+    key = f'POC2/MANIFEST/{source_id}.json'
+
+    def read():
+        try:
+            response = s3.get_object(Bucket="dex.test", Key=key)
+        except s3.exceptions.ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise
+            return None, {}
+        return response['ETag'], json.loads(response['Body'].read().decode('utf-8'))
+
+    def change(manifest):
+        if not entries and not any(key in manifest for key in removed):
+            return None
+        merged = dict(manifest)
+        for key in removed:
+            merged.pop(key, None)
+        merged.update(entries)
+        return merged
+
+    with metrics.phase('manifest'):
+        etag, manifest = read()
+        if update_json(s3, "dex.test", key, etag, manifest, change, read, attempts, backoff=0.1) is None:
+            print(f'Error when merging manifest {key}: gave up after {attempts} attempts')
+            return False
+    return True
+
+def remote_validators(file_url):
+    '''
+    Get the size, ETag and Last-Modified of a remote file with a HEAD request
+    Args:
+      file_url (string): the url of the target file
+    '''
+    with http_session.open_url(file_url, method='HEAD') as response:
+        headers = response.headers
+    size = headers.get('Content-Length')
+    return {'size': int(size) if size else None, 'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified')}
+
+def unchanged(known, remote):
+    '''
+    Whether the remote file is the one recorded in the manifest, the ETag wins over Last-Modified and size
+    Args:
+      known (dict): the entry of the file in the manifest
+      remote (dict): the validators returned by remote_validators
+    '''
+    if remote['etag'] and known.get('etag'):
+        return remote['etag'] == known['etag']
+    if remote['last_modified'] and known.get('last_modified'):
+        # With gzip negotiation Content-Length is the encoded size, not the size stored
+        return remote['last_modified'] == known['last_modified'] and remote['size'] == known.get('content_length', known.get('size'))
+    return False
+
+def ftp_unchanged(known, remote):
+    '''
+    Whether the remote ftp file is the one recorded in the manifest. FTP has no ETag, so the modify time
+    and size are compared, and a file on a server reporting neither is kept by its name.
+    Args:
+      known (dict): the entry of the file in the manifest
+      remote (dict): the size and modify time from ftp_backend.list_dir or ftp_backend.stat
+    '''
+    if remote['last_modified']:
+        return remote['last_modified'] == known.get('last_modified') and remote['size'] == known.get('size')
+    if remote['size'] is not None and known.get('size') is not None:
+        return remote['size'] == known['size']
+    return True
+
+# Transfer functions keyed by url scheme, see transport
+transports = {}
+
+def transport(*schemes):
+    '''
+    Register the function transferring the files of url schemes, a plugin adds a protocol with it.
+    The function takes (file_url, s3_path, known, remote, metrics, plan) like download_upload and returns
+    the manifest entry of the uploaded file, None if the file is unchanged.
+    Args:
+      schemes (string): the url schemes handled by the function
+    '''
+    def register(function):
+        for scheme in schemes:
+            transports[scheme] = function
+        return function
+    return register
+
+@transport('ftp')
+def ftp_download_upload(file_url, s3_path, known=None, remote=None, metrics=instrumentation.NOOP, plan=content_store.PATH):
+    '''
+    download file from ftp source and upload it to s3 bucket, unless the manifest shows it is unchanged
     Args:
       file_url (string): the url of the target file
       s3_path (string): the key in s3 bucket
+      known (dict, optional): the entry of the file in the manifest
+      remote (dict, optional): the size and modify time of the file from the directory listing
+      metrics (SourceMetrics, optional): the metrics of the task
+      plan (StoragePlan, optional): the storage plan of the source
+    Returns:
+      dict: the manifest entry of the uploaded file, None if the file is unchanged
     '''
-    data = urllib.request.urlopen(file_url).read()
-    s3.put_object(Bucket="dex.test", Key=s3_path, Body=data)
+    if remote is None:
+        with metrics.phase('check'):
+            remote = ftp_backend.stat(file_url)
+    if known and ftp_unchanged(known, remote):
+        return None
+    with ftp_backend.open_file(file_url, remote['size']) as response:
+        reader = HashingReader(response)
+        stored = store_content(reader, file_url, s3_path, plan, metrics=metrics)
+    metrics.add_retries(response.resumes)
+    return dict(stored, size=reader.size,
+                content_length=remote['size'],
+                etag=None,
+                last_modified=remote['last_modified'],
+                sha256=reader.sha256.hexdigest())
 
-def link_files(source,msg_receipt, overwrite = False):
+@transport('http', 'https')
+def http_download_upload(file_url, s3_path, known=None, remote=None, metrics=instrumentation.NOOP, plan=content_store.PATH):
     '''
-    Download files from a link and upload them to s3 bucket
+    download file from http source and upload it to s3 bucket
+    If the file is in the manifest, it is checked with a HEAD request and then a conditional GET,
+    so an unchanged file is neither transferred nor uploaded.
     Args:
-      source (dict): the message content from SQS(the complete info of the source)
-      msg_receipt (string): the receipt of the message from SQS, used to delete the message
-      overwrite (bool,optional): whether to overwrite the file in the s3 bucket
+      file_url (string): the url of the target file
+      s3_path (string): the key in s3 bucket
+      known (dict, optional): the entry of the file in the manifest
+      remote (dict, optional): the size and modify time of a ftp file from the directory listing
+      metrics (SourceMetrics, optional): the metrics of the task
+      plan (StoragePlan, optional): the storage plan of the source
+    Returns:
+      dict: the manifest entry of the uploaded file, None if the file is unchanged
     '''
-    source_url = source['URL']
-    print(f'Start handling ID: {source["ID"]}, URL: {source["URL"]} ')
+    headers = {}
+    if known:
+        try:
+            with metrics.phase('check'):
+                remote = remote_validators(file_url)
+            if unchanged(known, remote):
+                return None
+        except http_session.HTTPError as e:
+            # The server may not support HEAD, rely on the conditional GET
+            print(f'HEAD failed for {file_url}: {e}')
+        if known.get('etag'):
+            headers['If-None-Match'] = known['etag']
+        if known.get('last_modified'):
+            headers['If-Modified-Since'] = known['last_modified']
     try:
-        file_page = urllib.request.urlopen(source_url)
-        file_page = BeautifulSoup(file_page, 'html.parser')
-    except Exception as e:
-        print(f'Error when reading page: {e}')
-        handle_error(source['ID'], source['URL'], e, msg_receipt)
+        with contextlib.ExitStack() as stack:
+            # Time to first byte counts as download
+            with metrics.phase('download'):
+                response = stack.enter_context(http_session.open_url(file_url, headers))
+            metrics.add_retries(http_session.retries(response))
+            reader = HashingReader(response)
+            stored = store_content(reader, file_url, s3_path, plan, response.headers.get('Content-Type'), metrics)
+            content_length = response.headers.get('Content-Length')
+            return dict(stored, size=reader.size,
+                        content_length=int(content_length) if content_length else None,
+                        etag=response.headers.get('ETag'),
+                        last_modified=response.headers.get('Last-Modified'),
+                        sha256=reader.sha256.hexdigest())
+    except http_session.HTTPError as e:
+        if e.code == 304:
+            return None
+        raise
+
+def download_upload(file_url, s3_path, known=None, remote=None, metrics=instrumentation.NOOP, plan=content_store.PATH):
+    '''
+    download file and upload it to s3 bucket with the transport of its url scheme
+    Args:
+      file_url (string): the url of the target file
+      s3_path (string): the key in s3 bucket
+      known (dict, optional): the entry of the file in the manifest
+      remote (dict, optional): what the listing knows of the file (size, last_modified), or None
+      metrics (SourceMetrics, optional): the metrics of the task
+      plan (StoragePlan, optional): the storage plan of the source
+    Returns:
+      dict: the manifest entry of the uploaded file, None if the file is unchanged
+    '''
+    scheme = urllib.parse.urlsplit(file_url).scheme
+    if scheme not in transports:
+        raise ValueError(f'No transport for {scheme} url {file_url}')
+    return transports[scheme](file_url, s3_path, known, remote, metrics, plan)
+
+def host_slot(file_url):
+    '''
+    Get the semaphore limiting the concurrent transfers from the host of a url
+    Args:
+      file_url (string): the url of the target file
+    '''
+    host = urllib.parse.urlsplit(file_url).netloc
+    with host_slots_lock:
+        if host not in host_slots:
+            host_slots[host] = threading.BoundedSemaphore(host_limit)
+        return host_slots[host]
+
+def fetch_file(file_url, s3_path, known, remote=None, metrics=instrumentation.NOOP, plan=content_store.PATH):
+    '''
+    download_upload once a slot of the host is free
+    '''
+    with host_slot(file_url), guarded(file_url):
+        return download_upload(file_url, s3_path, known, remote, metrics, plan)
+
+def fetch_files(jobs, metrics=instrumentation.NOOP, plan=content_store.PATH):
+    '''
+    Download files and upload them to s3 bucket concurrently.
+    A failed file does not stop the others, it is reported in the summary instead.
+    Args:
+      jobs (list): (file_url, s3_path, known, remote) tuples, known is the manifest entry of the file or None,
+                   remote is the size and modify time of a ftp file from the directory listing or None
+      metrics (SourceMetrics, optional): the metrics of the task
+      plan (StoragePlan, optional): the storage plan of the source
+    Returns:
+      dict: 'succeeded' maps the s3 keys uploaded to their manifest entries,
+            'skipped' lists the s3 keys of unchanged files, 'failed' lists (file_url, error) tuples
+    '''
+    summary = {'succeeded': {}, 'skipped': [], 'failed': []}
+    if not jobs:
+        return summary
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs))) as pool:
+        futures = {pool.submit(fetch_file, *job, metrics=metrics, plan=plan): job for job in jobs}
+        for future in as_completed(futures):
+            file_url, s3_path = futures[future][:2]
+            try:
+                entry = future.result()
+            except Exception as e:
+                print(f'Error when handling file {file_url}: {e}')
+                summary['failed'].append((file_url, e))
+            else:
+                if entry is None:
+                    summary['skipped'].append(s3_path)
+                else:
+                    summary['succeeded'][s3_path] = entry
+    return summary
+
+def finish_files(task, msg_receipt, summary, metrics=instrumentation.NOOP):
+    '''
+    Report the summary of fetch_files and delete the message if every file is done.
+    With failed files the message stays in SQS, so the source is retried after the visibility timeout.
+    Args:
+      task (Task): the task of the source
+      msg_receipt (string): the receipt of the message from SQS, used to delete the message
+      summary (dict): the summary returned by fetch_files
+      metrics (SourceMetrics, optional): the metrics of the task
+    '''
+    print(f'ID: {task.id}, uploaded: {len(summary["succeeded"])}, unchanged: {len(summary["skipped"])}, failed: {len(summary["failed"])}')
+    if summary['failed']:
+        metrics.set_outcome('partial')
+        print(f'Not finished: {task.id}, the message is kept for retry')
     else:
-        print('Starting downloading files')
+        metrics.set_outcome('success' if summary['succeeded'] else 'unchanged')
+        print(f'Finished: {task.id}')
+        delete_message(msg_receipt)
+
+def dispatch_files(task, msg_receipt, jobs, manifest=True, metrics=instrumentation.NOOP):
+    '''
+    Enqueue one FILE task per file of a listing instead of transferring the files.
+    The message of the source is deleted once every task is sent, otherwise it is kept for retry.
+    Files whose listing shows they are unchanged (ftp) are not enqueued.
+    Args:
+      task (Task): the task of the source
+      msg_receipt (string): the receipt of the message from SQS, used to delete the message
+      jobs (list): (file_url, s3_path, known, remote) tuples, as for fetch_files
+      manifest (bool, optional): whether the FILE tasks record the files in the manifest of the source
+      metrics (SourceMetrics, optional): the metrics of the task
+    '''
+    bodies = []
+    for file_url, s3_path, known, remote in jobs:
+        if known and remote is not None and ftp_unchanged(known, remote):
+            continue
+        # The storage plan of the source goes with each file
+        bodies.append(FileTask(task.id, file_url, s3_path, known, remote, manifest,
+                               task.period, task.storage, task.compression).encode())
+    with metrics.phase('enqueue'):
+        failed = len(send_messages(sqs, queue_url, bodies, max_workers))
+    print(f'ID: {task.id}, dispatched: {len(bodies) - failed} of {len(jobs)} files, unchanged: {len(jobs) - len(bodies)}')
+    if failed:
+        metrics.set_outcome('partial')
+        print(f'Not finished: {task.id}, the message is kept for retry')
+    else:
+        metrics.set_outcome('dispatched' if bodies else 'unchanged')
+        delete_message(msg_receipt)
+
+def fanned_out(jobs):
+    '''
+    Whether the files of a listing are dispatched as FILE tasks
+    '''
+    return dispatch == 'fanout' and len(jobs) > fanout_threshold
+
+def file_tasks(tasks, metrics=instrumentation.NOOP):
+    '''
+    Transfer the files of FILE tasks concurrently, then record them in the manifest of their source
+    with one merge per source. A task is deleted once its file is transferred and recorded,
+    a failed one stays in SQS and is retried after the visibility timeout.
+    Args:
+      tasks (list): (FileTask, msg_receipt) tuples
+      metrics (SourceMetrics, optional): the metrics of the tasks
+    '''
+    # The tasks of one source share its storage plan
+    summary = fetch_files([(task.url, task.s3_path, task.known, task.remote) for task, _ in tasks],
+                          metrics, content_store.StoragePlan(tasks[0][0]))
+    done = set(summary['succeeded']) | set(summary['skipped'])
+    recorded = {}
+    for task, _ in tasks:
+        if task.manifest and task.s3_path in summary['succeeded']:
+            recorded.setdefault(task.id, {})[task.s3_path] = summary['succeeded'][task.s3_path]
+    for source_id, entries in recorded.items():
         try:
-            for f in file_page.find_all('a'):
-                file_url = urllib.parse.urljoin(source_url, f.get('href'))
-                file_name = file_url.split('/')[-1]
-                if file_name:
-                    #   urllib.request.urlretrieve(file_url, f'/tmp/{file_name}')
-                    # if overwrite:
-                    #      s3.upload_file(f'/tmp/{file_name}', 'dex.test', f'POC/LINKS_OVER/{file_name}')
-                    # else:
-                    #      s3.upload_file(f'/tmp/{file_name}', 'dex.test', f'POC/LINK/{file_name}')
-                    # sqs.delete_message(QueueUrl=queue_url,ReceiptHandle=msg_receipt)
-                    # os.remove(f'/tmp/{file_name}')
-                    if overwrite:
-                        # overwrite the file, no need to check repeat
-                        download_upload(file_url, f'POC2/LINKS_OVER/{file_name}')
-                    else:
-                        #To do: check repeat file!!!
-                        download_upload(file_url, f'POC2/LINK/{file_name}')
+            if not merge_manifest(source_id, entries, metrics=metrics):
+                done -= set(entries)
         except Exception as e:
-            print(f'Error when handling file: {e}')
-        else:
-            print(f'Finished: {source["ID"]}')
-            sqs.delete_message(QueueUrl=queue_url,ReceiptHandle=msg_receipt)
-            print("SQS Message deleted")
+            print(f'Error when merging manifest of {source_id}: {e}')
+            done -= set(entries)
+    for task, msg_receipt in tasks:
+        if task.s3_path in done:
+            delete_message(msg_receipt)
+        elif host_guard.retry_after(task.url):
+            defer_task(task, msg_receipt, host_guard.retry_after(task.url), f'circuit open for {host_guard.host_of(task.url)}')
+    print(f'FILE tasks: {len(tasks)}, uploaded: {len(summary["succeeded"])}, unchanged: {len(summary["skipped"])}, failed: {len(summary["failed"])}')
+    if summary['failed'] or len(done) < len(summary['succeeded']) + len(summary['skipped']):
+        metrics.set_outcome('partial')
+    else:
+        metrics.set_outcome('success' if summary['succeeded'] else 'unchanged')
+
+def page_links(source_url, pattern, metrics=instrumentation.NOOP):
+    '''
+    Get the links of a listing page matching the PATTERN of the source.
+    The page is scanned as it is downloaded, and parsed with BeautifulSoup only if the scanner finds no link at all.
+    Args:
+      source_url (string): the url of the listing page
+      pattern (string): the fnmatch pattern of the file names, every file if empty
+      metrics (SourceMetrics, optional): the metrics of the task
+    Returns:
+      list: (file_url, file_name) tuples
+    '''
+    hrefs = []
+    with metrics.phase('list'), guarded(source_url):
+        if link_parser != 'bs4':
+            with http_session.open_url(source_url, decode=True) as response:
+                hrefs = list(link_extractor.iter_hrefs(response))
+        # A page without any link the scanner recognises, not one without a file matching PATTERN yet
+        if not hrefs:
+            with http_session.open_url(source_url, decode=True) as response:
+                hrefs = link_extractor.soup_hrefs(response.read())
+    return list(link_extractor.filter_links(hrefs, source_url, pattern))
+
+
+class SourceType(object):
+    '''
+    How the files of a source type are found and stored, see source_type
+    '''
+    __slots__ = ('name', 'list_files', 'prefix', 'manifest', 'fanout', 'single')
+
+    def __init__(self, name, list_files, prefix, manifest=True, fanout=False, single=False):
+        self.name = name
+        self.list_files = list_files
+        self.prefix = prefix
+        self.manifest = manifest
+        self.fanout = fanout
+        self.single = single
+
+# Source types keyed by the TYPE column of the source csv file, see source_type
+source_types = {}
+
+def source_type(name, prefix, manifest=True, fanout=False, single=False):
+    '''
+    Register the function listing the files of a source type, a plugin adds a source type with it.
+    The function takes (task, metrics) and returns (file_url, file_name, remote) tuples, remote being
+    what the listing knows of the file (size, last_modified) or None. Every type then goes through run_source.
+    Args:
+      name (string): the TYPE of the sources
+      prefix (string): the s3 prefix of the files
+      manifest (bool, optional): whether the files are recorded in the manifest of the source, so unchanged
+                                 files are skipped. Without it every file is transferred and overwritten
+      fanout (bool, optional): whether the files can be dispatched as FILE tasks
+      single (bool, optional): whether the source is a single file, whose failure is the failure of the source
+    '''
+    def register(function):
+        source_types[name] = SourceType(name, function, prefix, manifest, fanout, single)
+        return function
+    return register
+
+@source_type('LINKS', 'POC2/LINK/', fanout=True)
+@source_type('LINKS_OVERWRITE', 'POC2/LINKS_OVER/', manifest=False, fanout=True)
+def link_files(task, metrics=instrumentation.NOOP):
+    '''
+    List the files linked from a page
+    '''
+    return [(file_url, file_name, None) for file_url, file_name in page_links(task.url, task.pattern, metrics)]
+
+@source_type('FTP_FILES', 'POC2/FTP_FILES/', fanout=True)
+def ftp_files(task, metrics=instrumentation.NOOP):
+    '''
+    List the files of a ftp directory matching the PATTERN of the source
+    '''
+    with metrics.phase('list'), guarded(task.url):
+        files = {f['name']: f for f in ftp_backend.list_dir(task.url)}
+    return [(urllib.parse.urljoin(task.url, file_name), file_name, files[file_name])
+            for file_name in fnmatch.filter(files, task.pattern)]
+
+@source_type('DIRECT', 'POC2/LINKS_DIRECT/', single=True)
+@source_type('DIRECT_FTP', 'POC2/FTP_FILE/', single=True)
+def direct_file(task, metrics=instrumentation.NOOP):
+    '''
+    The single file of a direct source, named by its PATTERN
+    '''
+    return [(task.url, task.pattern, None)]
 
-def dlinks_files(source, msg_receipt):
+def run_source(kind, task, msg_receipt, metrics=instrumentation.NOOP):
     '''
-    Download a file from direct link and upload it to s3 bucket
+    List the files of a source and download them to s3 bucket, or dispatch them as FILE tasks
     Args:
-      source (dict): the message content from SQS(the complete info of the source)
+      kind (SourceType): the type of the source
+      task (Task): the task of the source
       msg_receipt (string): the receipt of the message from SQS, used to delete the message
+      metrics (SourceMetrics, optional): the metrics of the task
     '''
-    print(f'Start handling ID: {source["ID"]}, URL: {source["URL"]} ')
-    file_name = source['PATTERN']
+    print(f'Start handling ID: {task.id}, URL: {task.url} ')
     try:
-        print("Start downloading a file")
-        # urllib.request.urlretrieve(source['URL'], f'/tmp/{file_name}')
-        # s3.upload_file(f'/tmp/{file_name}', 'dex.test', f'POC/LINKS_DIRECT/{file_name}')
-        # sqs.delete_message(QueueUrl=queue_url,ReceiptHandle=msg_receipt)
-        # os.remove(f'/tmp/{file_name}')
-
-        #To do: check repeat file!!!
-        download_upload(source['ID'], f'POC2/LINKS_DIRECT/{file_name}')
+        files = kind.list_files(task, metrics)
     except Exception as e:
-        print(f'Error when handling file: {e}')
-        handle_error(source['ID'], source['URL'], e, msg_receipt)
+        print(f'Error when listing files: {e}')
+        return source_failed(task, e, msg_receipt, metrics)
+    print(f'Start downloading {len(files)} files')
+    manifest = load_manifest(task.id, metrics) if kind.manifest else {}
+    jobs = []
+    for file_url, file_name, remote in files:
+        s3_path = kind.prefix + file_name
+        jobs.append((file_url, s3_path, manifest.get(s3_path), remote))
+    # The manifest only keeps the files of the current listing, so it does not grow with every period.
+    # An empty listing is more likely a broken page than a source without files, it prunes nothing
+    listed = set(s3_path for _, s3_path, _, _ in jobs)
+    stale = [key for key in manifest if key not in listed] if jobs else []
+    if kind.fanout and fanned_out(jobs):
+        if stale and not merge_manifest(task.id, {}, metrics=metrics, removed=stale):
+            print(f'Error when pruning manifest of {task.id}')
+        return dispatch_files(task, msg_receipt, jobs, kind.manifest, metrics)
+    summary = fetch_files(jobs, metrics, content_store.StoragePlan(task))
+    # Other listings of the source (fanned out files, other periods) may have written the manifest since it was read
+    if (kind.manifest and (summary['succeeded'] or stale)
+            and not merge_manifest(task.id, summary['succeeded'], metrics=metrics, removed=stale)):
+        metrics.set_outcome('partial')
+        print(f'Not finished: {task.id}, the manifest is not saved and the message is kept for retry')
+        return
+    if kind.single and summary['failed']:
+        source_failed(task, summary['failed'][0][1], msg_receipt, metrics)
     else:
-        print(f'Finished: {source["ID"]}')
-        sqs.delete_message(QueueUrl=queue_url,ReceiptHandle=msg_receipt)
-        print("SQS Message deleted")
+        finish_files(task, msg_receipt, summary, metrics)
 
-def ftp_files(source, msg_receipt):
-    """
-    Download files from ftp source and upload them to s3 bucket
+def run_task(task, msg_receipt):
+    '''
+    Execute a task depends on the source type
     Args:
-      source (dict): the message content from SQS(the complete info of the source)
+      task (Task or FileTask): the task decoded from the message
       msg_receipt (string): the receipt of the message from SQS, used to delete the message
-    """
+    '''
+    metrics = instrumentation.start(task)
+    try:
+        wait = host_guard.retry_after(task.url)
+        if wait:
+            # The host is down, do not spend the task on it
+            defer_task(task, msg_receipt, wait, f'circuit open for {host_guard.host_of(task.url)}', metrics)
+        elif task.type == FILE_TYPE:
+            file_tasks([(task, msg_receipt)], metrics)
+        elif task.type in source_types:
+            run_source(source_types[task.type], task, msg_receipt, metrics)
+        else:
+            metrics.set_outcome('error')
+            print("FILE TYPE ERROR")
+    except Exception:
+        metrics.set_outcome('error')
+        raise
+    finally:
+        metrics.emit()
 
-    print(f'Start handling ID: {source["ID"]}, URL: {source["URL"]} ')
+def release_messages(msg_receipts):
+    '''
+    Make received but unprocessed messages visible again for the next invocation
+    Args:
+      msg_receipts (list): the receipts of the messages from SQS
+    '''
+    for start in range(0, len(msg_receipts), 10):
+        entries = [{'Id': str(n), 'ReceiptHandle': receipt, 'VisibilityTimeout': 0}
+                   for n, receipt in enumerate(msg_receipts[start:start + 10])]
+        sqs.change_message_visibility_batch(QueueUrl=queue_url, Entries=entries)
+    print(f'{len(msg_receipts)} SQS Messages released')
 
-    try:
-        response = urllib.request.urlopen(source['URL'])
-        file_list = response.read().decode().split('\r\n')[0: -1]
-        files =  map(lambda x: x.split()[-1], file_list)
-        fnames = fnmatch.filter(files, source['PATTERN'])
-    except Exception as e:
-        print(f'Error when reading directory: {e}')
-        handle_error(source['ID'], source['URL'], e, msg_receipt)
-    else:
-        print("Start downloading files")
+def run_file_tasks(tasks):
+    '''
+    Execute the FILE tasks received together, the tasks of each source sharing one metrics record and storage plan
+    Args:
+      tasks (list): (FileTask, msg_receipt) tuples
+    '''
+    by_source = {}
+    for task, msg_receipt in tasks:
+        # Tasks of a source share a storage plan unless they were enqueued for different periods
+        key = (task.id, task.storage, task.compression, task.period)
+        by_source.setdefault(key, []).append((task, msg_receipt))
+    for key, source_tasks in by_source.items():
+        metrics = instrumentation.start(source_tasks[0][0])
         try:
-            for file_name in fnames:
-                file_url = urllib.parse.urljoin(source['URL'], file_name)
-                # urllib.request.urlretrieve(file_url, f'/tmp/{file_name}')
-                # s3.upload_file(f'/tmp/{file_name}', 'dex.test', f'POC/FTP_FILES/{file_name}')
-                # sqs.delete_message(QueueUrl=queue_url,ReceiptHandle=msg_receipt)
-                # os.remove(f'/tmp/{file_name}')
-
-                #To do: check repeat file!!!
-                download_upload(file_url, f'POC2/FTP_FILES/{file_name}')
+            with VisibilityHeartbeat(*[msg_receipt for _, msg_receipt in source_tasks]):
+                file_tasks(source_tasks, metrics)
         except Exception as e:
-            print(f'Error when handling file: {e}')
-        else:
-            print(f'Finished: {source["ID"]}')
-            sqs.delete_message(QueueUrl=queue_url,ReceiptHandle=msg_receipt)
-            print("SQS Message deleted")
+            metrics.set_outcome('error')
+            print(f'Error when executing FILE tasks: {e}')
+        finally:
+            metrics.emit()
 
-def dftp_files(source,  msg_receipt):
+def decode_task(message):
     '''
-    Download a file from direct ftp source and upload it to s3 bucket
+    Decode the task of a message. A malformed message is left in SQS, so it goes to the dead letter
+    queue after maxReceiveCount receives instead of failing the other messages received with it
     Args:
-      source (dict): the message content from SQS(the complete info of the source)
-      msg_receipt (string): the receipt of the message from SQS, used to delete the message
+      message (dict): a message received from SQS
+    Returns:
+      Task or FileTask: the task, None if the body is not a valid task
     '''
-    print(f'Start handling ID: {source["ID"]}, URL: {source["URL"]} ')
-    file_name = source['PATTERN']
     try:
-        print("Start downloading a file")
-        # urllib.request.urlretrieve(source['URL'], f'/tmp/{file_name}')
-        # s3.upload_file(f'/tmp/{file_name}', 'dex.test', f'POC/FTP_FILE/{file_name}')
-        # sqs.delete_message(QueueUrl=queue_url,ReceiptHandle=msg_receipt)
-        # os.remove(f'/tmp/{file_name}')
-
-        #To do: check repeat file!!!
-        download_upload(source['URL'], f'POC2/FTP_FILE/{file_name}')
+        return task_schema.decode(message['Body'])
     except Exception as e:
-        print(f'Error when handling file: {e}')
-        handle_error(source['ID'], source['URL'], e, msg_receipt)
-    else:
-        print(f'Finished: {source["ID"]}')
-        sqs.delete_message(QueueUrl=queue_url,ReceiptHandle=msg_receipt)
-        print("SQS Message deleted")
+        print(f'Malformed message skipped: {e}, body: {message["Body"][:200]!r}')
+        return None
+
+def drain(context):
+    '''
+    Long poll up to 10 messages at a time and execute them until the queue is empty
+    or the remaining time of the invocation reaches the safety margin
+    '''
+    while context.get_remaining_time_in_millis() > safety_margin_ms:
+        wait = int(min(20, (context.get_remaining_time_in_millis() - safety_margin_ms) / 1000))
+        response = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10, WaitTimeSeconds=wait,
+                                       VisibilityTimeout=visibility_timeout, AttributeNames=['ApproximateReceiveCount'])
+        messages = response.get('Messages', [])
+        remember_receives(messages)
+        if not messages:
+            print('Queue drained')
+            return
+        tasks = [(decode_task(message), message['ReceiptHandle']) for message in messages]
+        tasks = [(task, msg_receipt) for task, msg_receipt in tasks if task is not None]
+        # FILE tasks of a fanned out listing are transferred concurrently
+        files = [task for task in tasks if task[0].type == FILE_TYPE]
+        if files:
+            run_file_tasks(files)
+            flush_deletes()
+        tasks = [task for task in tasks if task[0].type != FILE_TYPE]
+        for n, (task, msg_receipt) in enumerate(tasks):
+            if context.get_remaining_time_in_millis() <= safety_margin_ms:
+                release_messages([receipt for _, receipt in tasks[n:]])
+                return
+            try:
+                with VisibilityHeartbeat(msg_receipt):
+                    run_task(task, msg_receipt)
+            except Exception as e:
+                # The message stays in SQS and is retried after the visibility timeout
+                print(f'Error when executing task: {e}')
+            flush_deletes()
+    print('Safety margin reached')
 
 def handler(event, context):
     '''
@@ -207,22 +998,33 @@ def handler(event, context):
     This function handler should be triggered by scheduled event at certain interval
     Receive messages(task) from SQS and execute tasks depends on the source type
     '''
-    count = 5
-    print("Attempt to receive 5 messages")
-    for i in range(0, count):
-        response1 = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=1)
-        if 'Messages' in response1:
-            msg_receipt = response1['Messages'][0]['ReceiptHandle']
-            msg_content = json.loads(response1['Messages'][0]['Body'])
-            if (msg_content['TYPE'] == "LINKS"):
-                link_files(msg_content,msg_receipt)
-            elif(msg_content['TYPE'] == "LINKS_OVERWRITE"):
-                link_files(msg_content, msg_receipt, overwrite = True)
-            elif(msg_content['TYPE'] == "DIRECT"):
-                dlinks_files(msg_content, msg_receipt)
-            elif(msg_content['TYPE'] == "DIRECT_FTP"):
-                dftp_files(msg_content, msg_receipt)
-            elif(msg_content['TYPE'] == "FTP_FILES"):
-                ftp_files(msg_content, msg_receipt)
-            else:
-                print("FILE TYPE ERROR")
+    try:
+        host_guard.restore(s3, "dex.test")
+        if consumer_mode == 'drain':
+            drain(context)
+        else:
+            count = 5
+            print("Attempt to receive 5 messages")
+            for i in range(0, count):
+                response1 = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=1,
+                                                VisibilityTimeout=visibility_timeout,
+                                                AttributeNames=['ApproximateReceiveCount'])
+                if 'Messages' in response1:
+                    remember_receives(response1['Messages'])
+                    msg_receipt = response1['Messages'][0]['ReceiptHandle']
+                    task = decode_task(response1['Messages'][0])
+                    if task is not None:
+                        try:
+                            with VisibilityHeartbeat(msg_receipt):
+                                run_task(task, msg_receipt)
+                        finally:
+                            # Delete before the next receive, which could otherwise get the message again
+                            flush_deletes()
+    finally:
+        flush_deletes()
+        report_errors()
+        receive_counts.clear()
+        host_guard.persist(s3, "dex.test")
+
+for plugin in filter(None, (name.strip() for name in os.environ.get('plugins', '').split(','))):
+    importlib.import_module(plugin)
@@ -0,0 +1,219 @@
+# @Author: Dex
+# @Email: ykydxt@gmail.com
+
+import os
+import ftplib
+import threading
+import contextlib
+import urllib.parse
+
+'''
+FTP client used by the downloader for FTP_FILES and DIRECT_FTP sources.
+Logged in control connections are kept per host and reused across files and warm invocations.
+Directories are listed with MLSD (NLST when the server does not support it), and a broken
+RETR is resumed with REST from the last byte received.
+
+Environment Variable：
+    ftp_timeout (string, optional): the socket timeout in seconds, 60 by default
+    ftp_resumes (string, optional): the number of times a broken transfer is resumed, 3 by default
+'''
+
+ftp_timeout = float(os.environ.get('ftp_timeout', '60'))
+ftp_resumes = int(os.environ.get('ftp_resumes', '3'))
+
+# Idle logged in connections, keyed by (host, port, user)
+idle = {}
+idle_lock = threading.Lock()
+
+def parse_url(url):
+    '''
+    Split a ftp url into its login and path
+    Returns:
+      tuple: ((host, port, user, password), path)
+    '''
+    parts = urllib.parse.urlsplit(url)
+    user = urllib.parse.unquote(parts.username) if parts.username else 'anonymous'
+    password = urllib.parse.unquote(parts.password) if parts.password else 'anonymous@'
+    return (parts.hostname, parts.port or 21, user, password), urllib.parse.unquote(parts.path) or '/'
+
+def connect(login):
+    '''
+    Open and log in a new control connection in binary mode
+    '''
+    host, port, user, password = login
+    conn = ftplib.FTP(timeout=ftp_timeout)
+    conn.connect(host, port)
+    conn.login(user, password)
+    conn.voidcmd('TYPE I')
+    return conn
+
+def checkout(login):
+    '''
+    Get an idle connection of a host if one is still alive, otherwise a new connection
+    '''
+    while True:
+        with idle_lock:
+            conns = idle.get(login[:3])
+            conn = conns.pop() if conns else None
+        if conn is None:
+            return connect(login)
+        try:
+            conn.voidcmd('NOOP')
+            return conn
+        except (OSError, EOFError, ftplib.Error):
+            close(conn)
+
+def connection_error(e):
+    '''
+    Whether an exception means the server could not be reached, broke the connection or is busy
+    '''
+    return isinstance(e, (OSError, EOFError, ftplib.error_temp))
+
+def checkin(login, conn):
+    '''
+    Give a connection back to be reused
+    '''
+    with idle_lock:
+        idle.setdefault(login[:3], []).append(conn)
+
+def close(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+@contextlib.contextmanager
+def connection(url):
+    '''
+    Borrow a logged in connection for the host of a url, a connection that failed is not reused
+    Yields:
+      tuple: (connection, path of the url)
+    '''
+    login, path = parse_url(url)
+    conn = checkout(login)
+    try:
+        yield conn, path
+    except Exception:
+        close(conn)
+        raise
+    else:
+        checkin(login, conn)
+
+def list_dir(url):
+    '''
+    List the files of a directory
+    Args:
+      url (string): the url of the directory
+    Returns:
+      list: {'name', 'size', 'last_modified'} of each file, size and last_modified are None if unknown
+    '''
+    with connection(url) as (conn, path):
+        try:
+            return [{'name': name,
+                     'size': int(facts['size']) if 'size' in facts else None,
+                     'last_modified': facts.get('modify')}
+                    for name, facts in conn.mlsd(path, facts=['type', 'size', 'modify'])
+                    if facts.get('type', 'file') == 'file']
+        except ftplib.error_perm:
+            # MLSD is not supported, names only
+            return [{'name': name.rsplit('/', 1)[-1], 'size': None, 'last_modified': None}
+                    for name in conn.nlst(path)]
+
+def stat(url):
+    '''
+    Get the size and modify time of a file with SIZE and MDTM
+    Returns:
+      dict: {'size', 'last_modified'}, each None if the server does not support the command
+    '''
+    with connection(url) as (conn, path):
+        result = {'size': None, 'last_modified': None}
+        try:
+            result['size'] = conn.size(path)
+        except ftplib.error_perm:
+            pass
+        try:
+            result['last_modified'] = conn.voidcmd(f'MDTM {path}').split()[-1]
+        except ftplib.error_perm:
+            pass
+        return result
+
+class RetrReader(object):
+    '''
+    Read a file with RETR as a stream. When the transfer breaks, a new connection is opened
+    and the transfer resumes with REST from the last byte received.
+    '''
+    def __init__(self, url, size=None):
+        self.url = url
+        self.size = size
+        self.login, self.path = parse_url(url)
+        self.conn = None
+        self.sock = None
+        self.offset = 0
+        self.resumes = 0
+        try:
+            self.start()
+        except Exception:
+            self.abandon()
+            raise
+
+    def start(self):
+        if self.conn is None:
+            self.conn = checkout(self.login)
+        # Listing switches the connection to ASCII mode
+        self.conn.voidcmd('TYPE I')
+        self.sock = self.conn.transfercmd(f'RETR {self.path}', self.offset or None)
+
+    def read(self, size=-1):
+        while True:
+            try:
+                chunk = self.sock.recv(size if size > 0 else 1024 * 1024)
+                if not chunk and self.size and self.offset < self.size:
+                    raise ConnectionError(f'transfer closed after {self.offset} of {self.size} bytes')
+                break
+            except OSError as e:
+                if self.resumes >= ftp_resumes:
+                    raise
+                self.resumes += 1
+                print(f'Resuming {self.url} at byte {self.offset}: {e}')
+                self.abandon()
+                self.start()
+        self.offset += len(chunk)
+        return chunk
+
+    def abandon(self):
+        '''
+        Drop the connection of a broken transfer
+        '''
+        if self.sock is not None:
+            close(self.sock)
+            self.sock = None
+        if self.conn is not None:
+            close(self.conn)
+            self.conn = None
+
+    def finish(self):
+        '''
+        Close the data connection and give the control connection back once the transfer is complete
+        '''
+        self.sock.close()
+        self.sock = None
+        self.conn.voidresp()
+        checkin(self.login, self.conn)
+        self.conn = None
+
+@contextlib.contextmanager
+def open_file(url, size=None):
+    '''
+    Open a file to be read as a stream
+    Args:
+      url (string): the url of the file
+      size (int, optional): the expected size, a transfer closed before it is resumed
+    '''
+    reader = RetrReader(url, size)
+    try:
+        yield reader
+    except Exception:
+        reader.abandon()
+        raise
+    else:
+        reader.finish()
@@ -0,0 +1,203 @@
+# @Author: Dex
+# @Email: ykydxt@gmail.com
+
+import os
+import json
+import time
+import random
+import threading
+import urllib.parse
+
+'''
+Per-host rate limiting and circuit breaking of the downloader.
+With host_rate set, every host has a token bucket: a request takes a token, and the rate is halved when
+the host throttles (429/503) and grows back slowly while requests succeed. It is off by default: every
+file of a listing takes a token, so a listing of thousands of files would not fit in the lambda timeout
+at a rate low enough to matter, and the connections per host are already bounded by host_limit.
+After breaker_failures failures in a row the circuit of the host opens, requests to it fail at once
+with CircuitOpen, and the tasks of the host are deferred until breaker_cooldown has passed. One request
+is then let through to probe the host. The tasks failing on the host before its circuit opens are
+deferred with a backoff growing with the failures in a row.
+The state is kept in the lambda container, and optionally saved to S3 so new containers start from it.
+
+Environment Variable：
+    host_rate (string, optional): the requests per second sent to a host, 0 (no limit) by default
+    host_burst (string, optional): the requests sent to a host at once before the rate applies, 10 by default
+    breaker_failures (string, optional): the failures in a row that open the circuit of a host, 5 by default
+    breaker_cooldown (string, optional): the seconds the circuit of a host stays open, 300 by default
+    guard_state (string, optional): the s3 key where the state is saved, not saved by default
+'''
+
+host_rate = float(os.environ.get('host_rate', '0'))
+host_burst = float(os.environ.get('host_burst', '10'))
+breaker_failures = int(os.environ.get('breaker_failures', '5'))
+breaker_cooldown = float(os.environ.get('breaker_cooldown', '300'))
+guard_state = os.environ.get('guard_state', '')
+
+# The rate of a throttled host does not go below this fraction of host_rate
+MIN_RATE_FACTOR = 1 / 32
+# The seconds a task is deferred after the first failure of its host, doubled at every failure in a row
+BACKOFF = 30
+
+class CircuitOpen(Exception):
+    '''
+    The circuit of the host is open, the request is not sent
+    '''
+    def __init__(self, host, retry_after):
+        super().__init__(f'Circuit open for {host}, retry in {retry_after:.0f}s')
+        self.host = host
+        self.retry_after = retry_after
+
+class HostGuard(object):
+    '''
+    The token bucket and circuit breaker of one host, shared by the threads of the container
+    '''
+    def __init__(self, host):
+        self.host = host
+        self.rate = host_rate
+        self.tokens = host_burst
+        self.updated = time.monotonic()
+        self.failures = 0
+        # Wall clock time, so it still means something when restored in another container
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def retry_after(self):
+        '''
+        The seconds until the circuit lets a request through, 0 if it is closed
+        '''
+        if self.opened_at is None:
+            return 0
+        return max(0.0, self.opened_at + breaker_cooldown - time.time())
+
+    def acquire(self):
+        '''
+        Wait for a token of the host
+        Raises:
+          CircuitOpen: the circuit is open, or half open with its probe already sent
+        '''
+        while True:
+            with self.lock:
+                if self.opened_at is not None:
+                    wait = self.retry_after()
+                    if wait > 0 or self.probing:
+                        raise CircuitOpen(self.host, wait or breaker_cooldown)
+                    self.probing = True
+                if host_rate <= 0:
+                    return
+                now = time.monotonic()
+                self.tokens = min(host_burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+            # Additive increase
+            self.rate = min(host_rate, self.rate + host_rate / 10)
+
+    def failure(self, throttled=False):
+        with self.lock:
+            if throttled:
+                # Multiplicative decrease
+                self.rate = max(host_rate * MIN_RATE_FACTOR, self.rate / 2)
+            self.failures += 1
+            if self.probing or self.failures >= breaker_failures:
+                if self.opened_at is None or self.probing:
+                    print(f'Circuit opened for {self.host} after {self.failures} failures')
+                self.opened_at = time.time()
+                self.probing = False
+
+    def state(self):
+        return {'rate': self.rate, 'failures': self.failures, 'opened_at': self.opened_at}
+
+# Guards kept in the lambda container, keyed by host
+guards = {}
+guards_lock = threading.Lock()
+restored = False
+# The state last saved, not saved again while it is unchanged
+saved_state = {}
+
+def host_of(url):
+    return urllib.parse.urlsplit(url).netloc
+
+def get(url):
+    '''
+    Get the guard of the host of a url
+    '''
+    host = host_of(url)
+    with guards_lock:
+        if host not in guards:
+            guards[host] = HostGuard(host)
+        return guards[host]
+
+def retry_after(url):
+    '''
+    The seconds until the host of a url accepts requests again, 0 if its circuit is closed
+    '''
+    with guards_lock:
+        guard = guards.get(host_of(url))
+    return guard.retry_after() if guard else 0
+
+def backoff(url):
+    '''
+    The seconds to defer a task whose host just failed while its circuit is still closed,
+    doubled at every failure of the host in a row up to breaker_cooldown, with jitter
+    '''
+    with guards_lock:
+        guard = guards.get(host_of(url))
+    failures = guard.failures if guard else 1
+    delay = min(breaker_cooldown, BACKOFF * 2 ** max(failures - 1, 0))
+    return random.uniform(delay / 2, delay)
+
+def restore(s3, bucket):
+    '''
+    Load the state saved by other containers, once per container
+    Args:
+      s3 (boto3 client): the s3 client
+      bucket (string): the bucket of the state object
+    '''
+    global restored, saved_state
+    if restored or not guard_state:
+        return
+    restored = True
+    try:
+        saved = json.loads(s3.get_object(Bucket=bucket, Key=guard_state)['Body'].read().decode('utf-8'))
+    except Exception as e:
+        print(f'No host state restored: {e}')
+        return
+    saved_state = saved
+    with guards_lock:
+        for host, state in saved.items():
+            guard = guards.setdefault(host, HostGuard(host))
+            guard.rate = min(host_rate, max(host_rate * MIN_RATE_FACTOR, state.get('rate') or host_rate))
+            guard.failures = state.get('failures', 0)
+            guard.opened_at = state.get('opened_at')
+
+def persist(s3, bucket):
+    '''
+    Save the state of the hosts that are throttled or failing, the last container to save wins
+    Args:
+      s3 (boto3 client): the s3 client
+      bucket (string): the bucket of the state object
+    '''
+    global saved_state
+    if not guard_state:
+        return
+    with guards_lock:
+        state = {host: guard.state() for host, guard in guards.items()
+                 if guard.failures or guard.opened_at is not None or guard.rate < host_rate}
+    if state == saved_state:
+        return
+    try:
+        s3.put_object(Bucket=bucket, Key=guard_state, Body=json.dumps(state).encode('utf-8'))
+        saved_state = state
+    except Exception as e:
+        print(f'Error when saving host state: {e}')
@@ -0,0 +1,97 @@
+# @Author: Dex
+# @Email: ykydxt@gmail.com
+
+import os
+import contextlib
+
+'''
+Pooled HTTP client used by the downloader for every http(s) fetch.
+Connections are kept alive and reused across files and warm invocations, so files from the
+same host do not pay a new TCP+TLS handshake each.
+Listing pages are requested compressed and decoded, files are transferred as the server stores them,
+so a .gz file is uploaded with its gzip bytes.
+
+Environment Variable：
+    host_limit (string, optional): the number of connections kept per host, 4 by default
+    http_timeout (string, optional): the read timeout in seconds, 60 by default
+    http_retries (string, optional): the number of retries of a failed request, 3 by default
+'''
+
+host_limit = int(os.environ.get('host_limit', '4'))
+http_timeout = float(os.environ.get('http_timeout', '60'))
+http_retries = int(os.environ.get('http_retries', '3'))
+
+# Created on first use and kept for the warm invocations of the lambda container
+pool = None
+
+class HTTPError(Exception):
+    '''
+    A response with a status other than 2xx
+    '''
+    def __init__(self, url, code, reason):
+        super().__init__(f'HTTP Error {code}: {reason} ({url})')
+        self.url = url
+        self.code = code
+        self.reason = reason
+
+def get_pool():
+    '''
+    Get the connection pool, creating it on first use
+    '''
+    global pool
+    if pool is None:
+        import urllib3
+        retries = urllib3.Retry(total=http_retries, backoff_factor=0.5,
+                                status_forcelist=(429, 500, 502, 503, 504),
+                                allowed_methods=('GET', 'HEAD'), raise_on_status=False)
+        pool = urllib3.PoolManager(num_pools=50, maxsize=host_limit, block=True,
+                                   timeout=urllib3.Timeout(connect=10, read=http_timeout),
+                                   retries=retries,
+                                   headers={'User-Agent': 'marketdata-downloader'})
+    return pool
+
+def connection_error(e):
+    '''
+    Whether an exception means the host could not be reached or did not answer
+    '''
+    if isinstance(e, OSError):
+        return True
+    import urllib3
+    return isinstance(e, (urllib3.exceptions.MaxRetryError, urllib3.exceptions.ProtocolError,
+                          urllib3.exceptions.TimeoutError, urllib3.exceptions.NewConnectionError))
+
+def retries(response):
+    '''
+    The number of retries it took to get a response
+    '''
+    return len(response.retries.history) if response.retries else 0
+
+@contextlib.contextmanager
+def open_url(url, headers=None, method='GET', decode=False):
+    '''
+    Send a request and yield the response to be read as a stream.
+    The connection goes back to the pool once the response is read, it is dropped on error.
+    Args:
+      url (string): the url of the target
+      headers (dict, optional): extra request headers
+      method (string, optional): the request method
+      decode (bool, optional): whether to ask for a compressed response and read it decoded,
+                               for pages that are parsed. A file is read with the bytes sent
+    Raises:
+      HTTPError: the status of the response is not 2xx
+    '''
+    if decode:
+        headers = dict(headers or {}, **{'Accept-Encoding': 'gzip, deflate'})
+    response = get_pool().request(method, url, headers=headers, preload_content=False, decode_content=decode)
+    if not 200 <= response.status < 300:
+        response.drain_conn()
+        response.release_conn()
+        raise HTTPError(url, response.status, response.reason)
+    try:
+        yield response
+    except Exception:
+        # The rest of the body is not wanted, do not reuse the connection
+        response.close()
+        raise
+    finally:
+        response.release_conn()
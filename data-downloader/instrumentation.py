@@ -0,0 +1,144 @@
+# @Author: Dex
+# @Email: ykydxt@gmail.com
+
+import os
+import json
+import time
+import threading
+
+'''
+Per-source timing metrics of the downloader.
+Each task records the time spent per phase (list, manifest, check, download, upload, enqueue), the files and
+bytes transferred, the retries and its outcome, and emits them as one log line when it is done.
+The time of the download and upload phases is summed over the files transferred concurrently.
+
+Environment Variable：
+    metrics (string, optional): "json" for a structured json line per source (default),
+                                "emf" for CloudWatch Embedded Metric Format, "off" to record nothing
+'''
+
+metrics_mode = os.environ.get('metrics', 'json')
+
+NAMESPACE = 'MarketDataDownloader'
+PHASES = ('list', 'manifest', 'check', 'download', 'upload', 'enqueue')
+
+class Phase(object):
+    '''
+    Time a block of code into a phase of a SourceMetrics
+    '''
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.metrics.add_time(self.name, time.perf_counter() - self.start)
+
+class SourceMetrics(object):
+    '''
+    The metrics of one task, shared by the threads transferring its files
+    '''
+    def __init__(self, task):
+        self.source_id = task.id
+        self.source_type = task.type
+        self.started = time.perf_counter()
+        self.seconds = dict.fromkeys(PHASES, 0.0)
+        self.files = 0
+        self.bytes = 0
+        self.retries = 0
+        self.outcome = 'unknown'
+        self.lock = threading.Lock()
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def add_file(self, size):
+        with self.lock:
+            self.files += 1
+            self.bytes += size
+
+    def add_retries(self, count):
+        if count:
+            with self.lock:
+                self.retries += count
+
+    def set_outcome(self, outcome):
+        self.outcome = outcome
+
+    def record(self):
+        '''
+        The metrics as a flat dict, times in milliseconds
+        '''
+        record = {'SourceId': self.source_id, 'Type': self.source_type, 'outcome': self.outcome,
+                  'total_ms': round((time.perf_counter() - self.started) * 1000, 1),
+                  'files': self.files, 'bytes': self.bytes, 'retries': self.retries}
+        for name, seconds in self.seconds.items():
+            record[f'{name}_ms'] = round(seconds * 1000, 1)
+        return record
+
+    def emit(self):
+        record = self.record()
+        if metrics_mode == 'emf':
+            # SourceId stays a property, as a dimension it would create one metric per source
+            units = {'files': 'Count', 'bytes': 'Bytes', 'retries': 'Count'}
+            record['_aws'] = {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': NAMESPACE,
+                    'Dimensions': [['Type'], ['Type', 'outcome']],
+                    'Metrics': [{'Name': name, 'Unit': units.get(name, 'Milliseconds')}
+                                for name in record if name.endswith('_ms') or name in units]}]}
+        print(json.dumps(record))
+
+class NoopPhase(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+class NoopMetrics(object):
+    '''
+    Stand-in recording nothing, used when metrics are off
+    '''
+    noop_phase = NoopPhase()
+
+    def phase(self, name):
+        return self.noop_phase
+
+    def add_time(self, name, seconds):
+        pass
+
+    def add_file(self, size):
+        pass
+
+    def add_retries(self, count):
+        pass
+
+    def set_outcome(self, outcome):
+        pass
+
+    def emit(self):
+        pass
+
+NOOP = NoopMetrics()
+
+def start(task):
+    '''
+    Start recording the metrics of a task
+    Args:
+      task (Task or FileTask): the task decoded from the message
+    '''
+    if metrics_mode == 'off':
+        return NOOP
+    return SourceMetrics(task)
@@ -0,0 +1,69 @@
+# @Author: Dex
+# @Email: ykydxt@gmail.com
+
+import re
+import html
+import fnmatch
+import urllib.parse
+
+'''
+Extract the links of a listing page while it is being downloaded.
+The page is scanned chunk by chunk with a regular expression instead of being parsed into a tree,
+so a multi-megabyte directory index costs one pass and a chunk of memory.
+'''
+
+HREF = re.compile(rb'''<a\s[^>]*?href\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))''', re.IGNORECASE)
+
+# A tag still open at the end of a chunk is carried over, unless it is clearly not a tag
+MAX_TAIL = 64 * 1024
+
+def iter_hrefs(stream, chunk_size=64 * 1024):
+    '''
+    Yield the href of every anchor of a page as the page is read
+    Args:
+      stream (file-like object): the response of the page
+      chunk_size (int, optional): the number of bytes read at once
+    '''
+    tail = b''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        buf = tail + chunk
+        cut = buf.rfind(b'<')
+        if cut != -1 and buf.find(b'>', cut) == -1 and len(buf) - cut < MAX_TAIL:
+            buf, tail = buf[:cut], buf[cut:]
+        else:
+            tail = b''
+        for match in HREF.finditer(buf):
+            yield html.unescape((match.group(1) or match.group(2) or match.group(3)).decode('utf-8', 'replace'))
+    for match in HREF.finditer(tail):
+        yield html.unescape((match.group(1) or match.group(2) or match.group(3)).decode('utf-8', 'replace'))
+
+def filter_links(hrefs, base_url, pattern=None):
+    '''
+    Resolve hrefs against the page url and keep the files matching the pattern
+    Args:
+      hrefs (iterable): the hrefs of the page
+      base_url (string): the url of the page
+      pattern (string, optional): the fnmatch pattern of the file names, every file if empty
+    Yields:
+      tuple: (file_url, file_name)
+    '''
+    match = re.compile(fnmatch.translate(pattern)).match if pattern else None
+    seen = set()
+    for href in hrefs:
+        file_url = urllib.parse.urljoin(base_url, href)
+        file_name = file_url.split('/')[-1]
+        if file_name and file_url not in seen and (match is None or match(file_name)):
+            seen.add(file_url)
+            yield file_url, file_name
+
+def soup_hrefs(page):
+    '''
+    The hrefs of a page parsed with BeautifulSoup, the fallback for pages the scanner gets nothing from
+    Args:
+      page (bytes): the content of the page
+    '''
+    from bs4 import BeautifulSoup
+    return [a.get('href') for a in BeautifulSoup(page, 'html.parser').find_all('a') if a.get('href')]
@@ -1,38 +1,260 @@
 # @Author: Dex
 # @Email: ykydxt@gmail.com
 
-import boto3
+import re
 import json
 import os
 import datetime
+from source_registry import get_registry
+from aws_clients import LazyClient
+from watermarks import Watermarks
+from sqs_batch import send_messages
+import error_report
+from task_schema import Task, TaskError
 
 '''
+Each run enqueues the periods of the interval missed since the last period enqueued for each source
+(its watermark), so a skipped or throttled run is caught up by the next one. A backfill event
+{"backfill": {"from": "2024-01-01T00:00:00", "to": "2024-01-31T23:59:59", "ids": ["ID", ...]}}
+enqueues every period of a date range ("to" defaults to now, "ids" to every active source) and
+continues in a new invocation when the lambda is about to time out.
+Periods are aligned in the local time of each source (its UTC column), so a daily source of UTC+10
+runs for the local day, and the watermarks and the backfill range are in that local time too.
+Active rows of the source csv file that are not valid sources are labelled Active: 2 and reported to
+developers with one SNS notification, like the sources failing in the downloader.
+
 Environment Variable：
     queue_name (string): the name of SQS queue
     source_bucket (string): the bucket of the source csv file
     source_key (string): the key of the source csv file
     interval (string): the interval of target sources
+    send_workers (string, optional): the number of send_message_batch calls sent at once, 8 by default
+    interval_minutes (string, optional): the length of a period of the interval in minutes, by default it is
+                                         read from the interval name (e.g. "5min", "30min", "hourly", "daily").
+                                         Without it the watermarks are not used and only the current run is enqueued
+    max_catchup (string, optional): the most periods a scheduled run catches up per source, 24 by default
+    backfill_batch (string, optional): the number of messages a backfill enqueues between deadline checks, 1000 by default
+    safety_margin (string, optional): the seconds before the lambda timeout when a backfill continues in a new invocation, 30 by default
 '''
 
-sqs = boto3.client('sqs')
-s3 = boto3.client('s3')
+sqs = LazyClient('sqs')
+s3 = LazyClient('s3')
+lambda_client = LazyClient('lambda')
+sns = LazyClient('sns')
 queue_url = f'https://sqs.ap-southeast-2.amazonaws.com/547051082101/{os.environ["queue_name"]}'
 
+send_workers = int(os.environ.get('send_workers', '8'))
+max_catchup = int(os.environ.get('max_catchup', '24'))
+backfill_batch = int(os.environ.get('backfill_batch', '1000'))
+safety_margin_ms = int(float(os.environ.get('safety_margin', '30')) * 1000)
+
+EPOCH = datetime.datetime(1970, 1, 1)
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+# Minutes of the units of an interval name
+UNITS = {'m': 1, 'min': 1, 'mins': 1, 'minute': 1, 'minutes': 1, 'h': 60, 'hour': 60, 'hours': 60,
+         'd': 1440, 'day': 1440, 'days': 1440, 'w': 10080, 'week': 10080, 'weeks': 10080}
+NAMED = {'minutely': 1, 'hourly': 60, 'daily': 1440, 'weekly': 10080}
+
+def period_of(interval):
+    '''
+    The length of a period of an interval
+    Args:
+      interval (string): the interval name, e.g. "5min", "1h", "hourly", "daily"
+    Returns:
+      timedelta: None if the length is not known
+    '''
+    if os.environ.get('interval_minutes'):
+        return datetime.timedelta(minutes=float(os.environ['interval_minutes']))
+    name = interval.strip().lower()
+    if name in NAMED:
+        return datetime.timedelta(minutes=NAMED[name])
+    match = re.fullmatch(r'(\d+)\s*([a-z]+)', name)
+    if match and match.group(2) in UNITS and int(match.group(1)) > 0:
+        return datetime.timedelta(minutes=int(match.group(1)) * UNITS[match.group(2)])
+    return None
+
+def period_start(time, step):
+    '''
+    The start of the period a time falls in, periods are aligned on the epoch of the timezone of the time
+    '''
+    seconds = step.total_seconds()
+    return EPOCH + datetime.timedelta(seconds=(time - EPOCH).total_seconds() // seconds * seconds)
+
+def date_tokens(run_time):
+    '''
+    The values available to the URL and PATTERN templates for a run time
+    Args:
+      run_time (datetime): the run time in the timezone of the source
+    '''
+    first_day = run_time.replace(day=1)
+    last_month = first_day - datetime.timedelta(days=1)
+    return {'year': run_time.strftime('%Y'),
+            'month': run_time.strftime('%m'),
+            'lastmonth': last_month.strftime('%m'),
+            'lastmonth_year': last_month.strftime('%Y'),
+            'day': run_time.strftime('%d'),
+            'hour': run_time.strftime('%H'),
+            'minute': run_time.strftime('%M')}
+
+class Schedule(object):
+    '''
+    The active sources of one interval, compiled once from the source registry into validated task templates.
+    The runs of sources are periods in their local time, the date tokens of a period are computed once.
+    '''
+    def __init__(self, sources):
+        '''
+        Args:
+          sources (list): the active sources of the interval, as returned by SourceRegistry.active
+        '''
+        self.sources = []
+        # {"ID", "URL", "REASON"} of the rows that are not valid sources
+        self.invalid = []
+        for source in sources:
+            try:
+                self.sources.append(Task.from_row(source))
+            except TaskError as e:
+                print(f'Invalid source skipped: {e}')
+                self.invalid.append({"ID": source[0], "URL": source[1], "REASON": str(e)})
+
+    def messages(self, runs):
+        '''
+        Format the templates of sources for their runs
+        Args:
+          runs (list): (Task, period) pairs, the task is a template of the schedule, the period is the start
+                       of the run in the local time of the source, which is the PERIOD of the task
+        Returns:
+          list: the message bodies to send to SQS, in the order of the runs
+        '''
+        tokens = {}
+        messages = []
+        for source, period in runs:
+            if period not in tokens:
+                tokens[period] = date_tokens(period)
+            run_tokens = tokens[period]
+            task = Task(source.id, source.type, source.url.format(**run_tokens), source.pattern.format(**run_tokens),
+                        source.utc, period.strftime(TIME_FORMAT), source.storage, source.compression)
+            messages.append(task.encode())
+        return messages
+
+    def missing(self, watermarks, now, step):
+        '''
+        The runs missed by every source since its watermark, up to its current period.
+        A source without a watermark only gets the current period, and a source is caught up by
+        at most max_catchup periods.
+        Args:
+          watermarks (dict): source ID -> the last period enqueued
+          now (datetime): the time of the run, UTC
+          step (timedelta): the length of a period
+        Returns:
+          list: (source, period) pairs, the periods of a source in order
+        '''
+        runs = []
+        for source in self.sources:
+            current = current_period(source, now, step)
+            last = watermarks.get(source.id)
+            first = current if last is None else last + step
+            count = int((current - first) / step) + 1 if first <= current else 0
+            if count > max_catchup:
+                print(f'Source {source.id} missed {count} periods, only the last {max_catchup} are enqueued')
+                first, count = current - (max_catchup - 1) * step, max_catchup
+            runs.extend((source, first + n * step) for n in range(count))
+        return runs
+
+def current_period(source, now, step):
+    '''
+    The start of the period of a source that now falls in, in the local time of the source
+    Args:
+      source (Task): the template of the source
+      now (datetime): the time, UTC
+      step (timedelta): the length of a period
+    '''
+    return period_start(now + datetime.timedelta(hours=source.offset), step)
+
+def enqueue_runs(schedule, runs):
+    '''
+    Enqueue the runs of sources
+    Args:
+      schedule (Schedule): the schedule of the sources
+      runs (list): (source, period) pairs, the periods of a source in order
+    Returns:
+      dict: source ID -> the last period enqueued with every period before it also enqueued
+    '''
+    failed = send_messages(sqs, queue_url, schedule.messages(runs), send_workers)
+    enqueued = {}
+    blocked = set()
+    for index, (source, period) in enumerate(runs):
+        if index in failed:
+            blocked.add(source.id)
+        elif source.id not in blocked:
+            enqueued[source.id] = period
+    print(f'Appended {len(runs) - len(failed)} of {len(runs)} messages for {len(set(source.id for source, _ in runs))} sources')
+    return enqueued
+
+def backfill(schedule, watermarks, step, request, context):
+    '''
+    Enqueue every period of a date range, in chunks of backfill_batch messages.
+    When the lambda is about to time out, the rest of the range is handed to a new invocation.
+    Args:
+      schedule (Schedule): the schedule of the sources
+      watermarks (Watermarks): the watermarks of the interval, moved when the backfill joins them
+      step (timedelta): the length of a period
+      request (dict): {"from", "to" (optional), "ids" (optional)} of the backfill event, in the local time of
+                      the sources. Without "to" every source is backfilled up to its current period
+      context (LambdaContext): the context of the invocation
+    '''
+    if request.get('ids'):
+        ids = set(request['ids'])
+        schedule.sources = [source for source in schedule.sources if source.id in ids]
+    if not schedule.sources:
+        print('No active source to backfill')
+        return
+    start = period_start(datetime.datetime.strptime(request['from'], TIME_FORMAT), step)
+    if request.get('to'):
+        end = period_start(datetime.datetime.strptime(request['to'], TIME_FORMAT), step)
+        ends = {source.id: end for source in schedule.sources}
+    else:
+        now = datetime.datetime.utcnow()
+        ends = {source.id: current_period(source, now, step) for source in schedule.sources}
+        end = max(ends.values())
+    watermarks.load()
+    per_chunk = max(1, backfill_batch // len(schedule.sources))
+    period = start
+    while period <= end:
+        if context.get_remaining_time_in_millis() < safety_margin_ms:
+            # Without "to", the new invocation goes up to the current period of each source again
+            rest = {'backfill': dict(request, **{'from': period.strftime(TIME_FORMAT)})}
+            lambda_client.invoke(FunctionName=context.function_name, InvocationType='Event',
+                                 Payload=json.dumps(rest).encode('utf-8'))
+            print(f'Backfill continues from {rest["backfill"]["from"]} in a new invocation')
+            return
+        periods = [period + n * step for n in range(per_chunk) if period + n * step <= end]
+        runs = [(source, run) for source in schedule.sources for run in periods if run <= ends[source.id]]
+        watermarks.advance(enqueue_runs(schedule, runs), start=periods[0], step=step)
+        period = periods[-1] + step
+    print(f'Backfill done up to {end.strftime(TIME_FORMAT)}')
+
 def handler(event, context):
-	'''
+    '''
     Read source info(of certain interval) from a csv file in S3 bucket
-    This handler should be triggered by scheduled event at certain interval 
-    '''
-    source_data = s3.get_object(Bucket=os.environ['source_bucket'], Key=os.environ['source_key'])['Body'].read().decode('utf-8')
-    source_ls = source_data.split('\r\n')
-    source_list = map(lambda x: x.split(','), source_ls)
-    for source in source_list:
-    	# source[4] belongs to header "Active",value 0 means inactive, 1 means active, 2 means something wrong with the source and needs fix
-        if (source[4] == "1") & (source[2] == os.environ['interval']):
-            utc_offset_hours = int(source[9])
-            run_time = datetime.datetime.utcnow()+datetime.timedelta(hours=utc_offset_hours)
-            source[8] = source[8].format(year=run_time.strftime('%Y'), month=run_time.strftime('%m'), lastmonth=f'0{int(run_time.strftime("%m"))-1}', day=run_time.strftime('%d'), hour=run_time.strftime('%H'), minute=run_time.strftime('%M'))
-            source[1] = source[1].format(year=run_time.strftime('%Y'), month=run_time.strftime('%m'), lastmonth=f'0{int(run_time.strftime("%m"))-1}', day=run_time.strftime('%d'), hour=run_time.strftime('%H'), minute=run_time.strftime('%M'))
-            print(f'Appending: {source[1]}')
-            msg = json.dumps({ "ID": source[0], "URL": source[1], "TYPE": source[7], "PATTERN": source[8], "UTC": source[9]})
-            response = sqs.send_message(QueueUrl=queue_url, MessageBody=msg)
+    This handler should be triggered by scheduled event at certain interval
+    '''
+    interval = os.environ['interval']
+    registry = get_registry(s3, os.environ['source_bucket'], os.environ['source_key'])
+    schedule = Schedule(registry.active(interval))
+    if schedule.invalid:
+        # Labelled Active: 2, so they are reported once and not harvested until their row is fixed
+        error_report.report(registry, sns, schedule.invalid, 'Marketdata Harvester')
+    step = period_of(interval)
+    now = datetime.datetime.utcnow()
+    if step is None:
+        if event.get('backfill'):
+            print(f'Error: cannot backfill interval {interval} without interval_minutes')
+            return
+        enqueue_runs(schedule, [(source, now + datetime.timedelta(hours=source.offset)) for source in schedule.sources])
+        return
+    watermarks = Watermarks(s3, os.environ['source_bucket'], os.environ['source_key'], interval)
+    if event.get('backfill'):
+        return backfill(schedule, watermarks, step, event['backfill'], context)
+    runs = schedule.missing(watermarks.load(), now, step)
+    watermarks.advance(enqueue_runs(schedule, runs))
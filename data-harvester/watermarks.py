@@ -0,0 +1,96 @@
+# @Author: Dex
+# @Email: ykydxt@gmail.com
+
+import json
+import datetime
+from conditional_put import update_json
+
+'''
+Watermarks of the harvester: the last period enqueued for each source of an interval, in the local
+time of the source.
+They are kept in a small object next to the source csv file (<source_key>.<interval>.watermarks.json)
+and written with conditional puts, so a scheduled run and a backfill running at the same time
+do not overwrite each other.
+'''
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+def parse(content):
+    '''
+    The watermarks of the content of the object, source ID -> datetime
+    '''
+    return {source_id: datetime.datetime.strptime(period, TIME_FORMAT) for source_id, period in content.items()}
+
+def dump(periods):
+    '''
+    The content of the object of watermarks, source ID -> string
+    '''
+    return {source_id: period.strftime(TIME_FORMAT) for source_id, period in periods.items()}
+
+class Watermarks(object):
+    '''
+    The watermarks of the sources of one interval
+    '''
+    def __init__(self, s3, bucket, source_key, interval):
+        '''
+        Args:
+          s3 (boto3 client): the s3 client
+          bucket (string): the bucket of the source csv file
+          source_key (string): the key of the source csv file
+          interval (string): the interval of the sources
+        '''
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = f'{source_key}.{interval}.watermarks.json'
+        self.etag = None
+        self.periods = {}
+
+    def load(self):
+        '''
+        Read the watermarks from S3
+        Returns:
+          dict: source ID -> the start (UTC datetime) of the last period enqueued
+        '''
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=self.key)
+        except self.s3.exceptions.ClientError as e:
+            if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                raise
+            self.etag, self.periods = None, {}
+        else:
+            self.etag = response['ETag']
+            self.periods = parse(json.loads(response['Body'].read().decode('utf-8')))
+        return self.periods
+
+    def advance(self, periods, start=None, step=None, attempts=5):
+        '''
+        Move the watermarks of sources forward, a watermark never goes back.
+        The write is conditional on the object not having changed since it was read, on a conflict
+        the watermarks are read again and the update is applied on top of them (see conditional_put.py).
+        Args:
+          periods (dict): source ID -> the last period enqueued
+          start (datetime, optional): the first period enqueued, for a backfill. A watermark is only
+                                      moved when the backfill continues it without leaving a gap
+          step (timedelta, optional): the length of a period, needed with start
+          attempts (int, optional): the number of conditional writes tried
+        '''
+        def change(content):
+            current_periods = parse(content)
+            merged = dict(current_periods)
+            for source_id, period in periods.items():
+                current = merged.get(source_id)
+                if start is not None and (current is None or current + step < start):
+                    continue
+                if current is None or period > current:
+                    merged[source_id] = period
+            return dump(merged) if merged != current_periods else None
+
+        def reload():
+            self.load()
+            return self.etag, dump(self.periods)
+
+        written = update_json(self.s3, self.bucket, self.key, self.etag, dump(self.periods), change, reload, attempts)
+        if written is None:
+            print(f'Error when saving watermarks: gave up after {attempts} attempts')
+            return
+        self.etag, self.periods = written[0], parse(written[1])
@@ -1,12 +1,34 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 # https://stackoverflow.com/questions/40383470/can-i-force-cloudformation-to-delete-non-empty-s3-bucket
+import os
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import boto3
 import botocore
 from botocore.vendored import requests
 
+'''
+Empty the test bucket when its stack is deleted.
+The prefixes are listed in parallel and every page of 1000 keys is deleted with one delete_objects call.
+When the lambda is about to time out, it invokes itself with the same event to carry on and the
+last invocation sends the response to CloudFormation.
+
+Environment Variable：
+    delete_workers (string, optional): the number of delete_objects calls sent at once, 8 by default
+    safety_margin (string, optional): the seconds before the lambda timeout when the work is handed over, 30 by default
+    max_continuations (string, optional): the number of times the work is handed over before giving up, 20 by default
+'''
+
 s3 = boto3.resource('s3')
+lambda_client = boto3.client('lambda')
+
+PREFIXES = ['in/', 'processing/', 'done/']
+
+delete_workers = int(os.environ.get('delete_workers', '8'))
+safety_margin_ms = int(float(os.environ.get('safety_margin', '30')) * 1000)
+max_continuations = int(os.environ.get('max_continuations', '20'))
 
 def can_access_bucket(bucket):
     try:
@@ -23,6 +45,84 @@ def can_access_bucket(bucket):
 
         return False
 
+class BatchDeleter(object):
+    '''
+    Delete the objects under prefixes of a bucket with delete_objects, until the deadline of the invocation
+    '''
+    def __init__(self, bucket_name, context):
+        self.bucket_name = bucket_name
+        self.context = context
+        self.pool = ThreadPoolExecutor(max_workers=delete_workers)
+        # Bounds the pages listed but not deleted yet
+        self.pending = threading.BoundedSemaphore(delete_workers * 2)
+        self.lock = threading.Lock()
+        self.deleted = 0
+        self.errors = 0
+
+    def out_of_time(self):
+        return self.context.get_remaining_time_in_millis() < safety_margin_ms
+
+    def delete_batch(self, keys):
+        try:
+            response = s3.meta.client.delete_objects(Bucket=self.bucket_name,
+                                                     Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True})
+            errors = response.get('Errors', [])
+            for error in errors[:10]:
+                print(f"Error when deleting {error['Key']}: {error['Code']} {error['Message']}")
+            with self.lock:
+                self.deleted += len(keys) - len(errors)
+                self.errors += len(errors)
+        except Exception as e:
+            print(f'Error when deleting {len(keys)} objects: {e}')
+            with self.lock:
+                self.errors += len(keys)
+        finally:
+            self.pending.release()
+
+    def delete_prefix(self, prefix):
+        '''
+        List a prefix page by page and hand every page to the delete workers
+        Returns:
+          bool: whether the whole prefix was listed before the deadline
+        '''
+        paginator = s3.meta.client.get_paginator('list_objects_v2')
+        # The folder marker itself is listed under its prefix and deleted with the other keys
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix, PaginationConfig={'PageSize': 1000}):
+            keys = [obj['Key'] for obj in page.get('Contents', [])]
+            if keys:
+                self.pending.acquire()
+                self.pool.submit(self.delete_batch, keys)
+            if self.out_of_time():
+                return False
+        return True
+
+    def run(self, prefixes):
+        '''
+        Delete the objects of the prefixes, listed in parallel
+        Returns:
+          bool: whether every object is deleted
+        '''
+        with ThreadPoolExecutor(max_workers=len(prefixes)) as listers:
+            listed = all(list(listers.map(self.delete_prefix, prefixes)))
+        self.pool.shutdown(wait=True)
+        print(f'Deleted {self.deleted} objects, {self.errors} errors')
+        return listed and self.errors == 0
+
+def continue_later(event, context):
+    '''
+    Invoke this lambda again with the same event to delete the rest of the objects
+    Returns:
+      bool: whether the work was handed over
+    '''
+    continuation = event.get('Continuation', 0) + 1
+    if continuation > max_continuations:
+        print(f'Giving up after {max_continuations} continuations')
+        return False
+    lambda_client.invoke(FunctionName=context.function_name, InvocationType='Event',
+                         Payload=json.dumps(dict(event, Continuation=continuation)).encode('utf8'))
+    print(f'Continuation {continuation} invoked')
+    return True
+
 def lambda_handler(event, context):
     try:
         bucketName = event['ResourceProperties']['BucketName']
@@ -32,15 +132,12 @@ def lambda_handler(event, context):
 
         if bucket and can_access_bucket(bucket):
             if event['RequestType'] == 'Delete':
-                for obj in bucket.objects.filter(Prefix='in/'):
-                    s3.Object(bucket.name, obj.key).delete()
-                    s3.Object(bucket.name, 'in/').delete()
-                for obj in bucket.objects.filter(Prefix='processing/'):
-                    s3.Object(bucket.name, obj.key).delete()
-                    s3.Object(bucket.name, 'processing/').delete()
-                for obj in bucket.objects.filter(Prefix='done/'):
-                    s3.Object(bucket.name, obj.key).delete()
-                    s3.Object(bucket.name, 'done/').delete()
+                if not BatchDeleter(bucket.name, context).run(PREFIXES):
+                    if continue_later(event, context):
+                        # The last continuation answers CloudFormation
+                        return
+                    sendResponseCfn(event, context, "FAILED")
+                    return
 
         sendResponseCfn(event, context, "SUCCESS")
     except Exception as e: